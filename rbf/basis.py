@@ -37,19 +37,43 @@ Wendland (d=3, k=2)                wen32         Yes (1, 2, and 3-D)  :math:`(1
 =================================  ============  ===================  ======================================
 
 ''' 
-from __future__ import division 
+from __future__ import division
+from concurrent.futures import ThreadPoolExecutor
+import ctypes
 import logging
-
-import sympy 
-import numpy as np 
+import hashlib
+import importlib.util
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import types
+
+import sympy
+import numpy as np
 from scipy.sparse import csc_matrix
 from scipy.spatial import cKDTree
-from sympy.utilities.autowrap import ufuncify
 
 from rbf.poly import powers
 from rbf.utils import assert_shape
 logger = logging.getLogger(__name__)
 
+try:
+  import numba
+  # the generated kernels are parallel, and numba's default threading
+  # layer (TBB, when available) hangs the interpreter at exit in any
+  # process that forks after one of them has run, including the
+  # workers spawned by rbf.mp.parmap. Pin the fork-safe workqueue
+  # layer unless one was explicitly chosen
+  if numba.config.THREADING_LAYER == 'default':
+    numba.config.THREADING_LAYER = 'workqueue'
+
+  _HAS_NUMBA = True
+
+except ImportError:
+  _HAS_NUMBA = False
+
 
 def get_r():
   ''' 
@@ -73,6 +97,511 @@ _EPS = get_eps()
 _R = get_r()
 
 
+# numerical functions shared across `RBF` instances. The functions are
+# a pure product of the expression, `tol`, `limits` and `diff`, so
+# recreating an equivalent `RBF` reuses them rather than rerunning the
+# symbolic differentiation and compilation
+_FUNC_CACHE = {}
+
+
+def _expr_key(expr):
+  '''
+  returns a string which uniquely identifies `expr`. This is used to
+  key compiled functions on disk so that processes evaluating the same
+  expression share compiled modules
+  '''
+  return hashlib.sha1(sympy.srepr(expr).encode()).hexdigest()
+
+
+# the directory where generated kernel modules and shared libraries
+# are cached, determined on first use
+_CACHE_DIR = None
+
+
+def _cache_dir():
+  '''
+  returns a private per-user directory where the generated kernel
+  modules and shared libraries are cached. Code is imported from this
+  directory, so it must not be writable by any other user
+  '''
+  global _CACHE_DIR
+  if _CACHE_DIR is None:
+    base = os.environ.get('XDG_CACHE_HOME')
+    if not base:
+      home = os.path.expanduser('~')
+      base = os.path.join(home, '.cache') if home != '~' else None
+
+    path = None
+    if base:
+      path = os.path.join(base, 'rbf.basis')
+      os.makedirs(path, mode=0o700, exist_ok=True)
+      if os.name == 'posix':
+        st = os.stat(path)
+        if (st.st_uid != os.getuid()) or (st.st_mode & 0o022):
+          # the directory belongs to another user or is writable by
+          # one, so it cannot be trusted
+          path = None
+
+    if path is None:
+      # there is no usable per-user location, fall back to a private
+      # temporary directory. The kernels are then not shared across
+      # processes
+      path = tempfile.mkdtemp(prefix='rbf.basis-')
+
+    _CACHE_DIR = path
+
+  return _CACHE_DIR
+
+
+def _compiled_ufunc_dir(expr):
+  '''
+  returns the directory where the compiled function for `expr` is (or
+  should be) stored
+  '''
+  return os.path.join(_cache_dir(), _expr_key(expr))
+
+
+def _publish_file(fname, data):
+  '''
+  atomically creates `fname` with the contents `data`. The data is
+  written to a temporary file which is then renamed to `fname`, so a
+  concurrent process importing the file can never see a partial write
+  '''
+  fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(fname))
+  try:
+    with os.fdopen(fd, 'w') as f:
+      f.write(data)
+
+    os.replace(tmpname, fname)
+  except BaseException:
+    os.unlink(tmpname)
+    raise
+
+
+# a short string identifying the CPU of this host, determined on
+# first use
+_HOST_KEY = None
+
+
+def _host_key():
+  '''
+  returns a short string identifying the CPU of this host. The C
+  kernels are compiled with `-march=native`, so they are keyed on the
+  host CPU in case the cache directory is shared between machines
+  (e.g. an NFS home directory)
+  '''
+  global _HOST_KEY
+  if _HOST_KEY is None:
+    info = platform.machine()
+    try:
+      with open('/proc/cpuinfo') as f:
+        info += ''.join(
+          line for line in f
+          if line.startswith(('model name', 'flags', 'Features')))
+
+    except OSError:
+      info += platform.processor()
+
+    _HOST_KEY = hashlib.sha1(info.encode()).hexdigest()[:8]
+
+  return _HOST_KEY
+
+
+# template for the numba kernels generated by `_compile_numba_kernel`.
+# The kernel writes the RBF, evaluated at the points `x` with the
+# centers `c`, to `out` with a single fused loop rather than
+# materializing an (N, M) array for each subexpression
+_NUMBA_KERNEL_TEMPLATE = '''
+import math
+from numba import njit, prange
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _kernel(x, c, eps, out):
+  for i in prange(x.shape[0]):
+    for j in range(c.shape[0]):
+      out[i, j] = %(expr)s
+'''
+
+
+def _compile_numba_kernel(expr, x_sym, c_sym):
+  '''
+  compiles `expr`, which is a function of `x_sym`, `c_sym` and `eps`,
+  into a numba kernel with the signature `(x, c, eps, out)`. The
+  generated source is saved on disk so that numba can cache the
+  compiled kernel across processes
+  '''
+  # replace the symbols with expressions indexing the kernel arguments
+  mapping = {_EPS: sympy.Symbol('eps[j]')}
+  mapping.update(
+    (xi, sympy.Symbol('x[i, %d]' % d)) for d, xi in enumerate(x_sym))
+  mapping.update(
+    (ci, sympy.Symbol('c[j, %d]' % d)) for d, ci in enumerate(c_sym))
+  source = _NUMBA_KERNEL_TEMPLATE % {
+    'expr': sympy.printing.pycode(expr.xreplace(mapping))}
+
+  # The generated module is written to the per-user cache directory
+  # and imported by name so that numba can locate it when caching and
+  # parallelizing the kernel
+  tempdir = _cache_dir()
+  modname = 'rbf_numba_kernel_%s' % _expr_key(expr)
+  fname = os.path.join(tempdir, '%s.py' % modname)
+  if not os.path.isfile(fname):
+    _publish_file(fname, source)
+
+  if tempdir not in sys.path:
+    sys.path.append(tempdir)
+
+  mod = importlib.import_module(modname)
+  return mod._kernel
+
+
+# template for the numba kernels generated by
+# `_compile_numba_gather_kernel`. The kernel evaluates the expression
+# for the (point, center) pairs selected by the index arrays `rows`
+# and `cols`, which is the evaluation pattern for the nonzero entries
+# of a `SparseRBF`. Gathering inside the loop avoids materializing
+# the nnz-by-D copies of `x` and `c` that fancy indexing would make
+_NUMBA_GATHER_KERNEL_TEMPLATE = '''
+import math
+from numba import njit, prange
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _kernel(rows, cols, x, c, eps, out):
+  for k in prange(out.shape[0]):
+    i = rows[k]
+    j = cols[k]
+    out[k] = %(expr)s
+'''
+
+
+def _compile_numba_gather_kernel(expr, x_sym, c_sym):
+  '''
+  compiles `expr` into a numba kernel which evaluates the expression
+  for the (point, center) pairs selected by a pair of index arrays,
+  with the signature `(rows, cols, x, c, eps, out)`
+  '''
+  mapping = {_EPS: sympy.Symbol('eps[j]')}
+  mapping.update(
+    (xi, sympy.Symbol('x[i, %d]' % d)) for d, xi in enumerate(x_sym))
+  mapping.update(
+    (ci, sympy.Symbol('c[j, %d]' % d)) for d, ci in enumerate(c_sym))
+  source = _NUMBA_GATHER_KERNEL_TEMPLATE % {
+    'expr': sympy.printing.pycode(expr.xreplace(mapping))}
+
+  tempdir = _cache_dir()
+  modname = 'rbf_numba_gather_kernel_%s' % _expr_key(expr)
+  fname = os.path.join(tempdir, '%s.py' % modname)
+  if not os.path.isfile(fname):
+    _publish_file(fname, source)
+
+  if tempdir not in sys.path:
+    sys.path.append(tempdir)
+
+  mod = importlib.import_module(modname)
+  return mod._kernel
+
+
+def _as_gather_evaluator(kernel):
+  '''
+  wraps a numba gather kernel so that it allocates its own output
+  array and has the call signature
+  `(rows, cols, x, c, eps) -> (nnz,) array`
+  '''
+  def evaluator(rows, cols, x, c, eps):
+    x = np.ascontiguousarray(x)
+    c = np.ascontiguousarray(c)
+    eps = np.ascontiguousarray(eps)
+    out = np.empty(rows.shape[0], dtype=float)
+    kernel(rows, cols, x, c, eps, out)
+    return out
+
+  return evaluator
+
+
+def _as_gather_evaluator_from_pairs(pair_evaluator):
+  '''
+  converts an evaluator over paired points and centers to one with the
+  call signature `(rows, cols, x, c, eps) -> (nnz,) array`
+  '''
+  def evaluator(rows, cols, x, c, eps):
+    return pair_evaluator(x[rows], c[cols], eps[cols])
+
+  return evaluator
+
+
+# pair evaluations below this size are not worth distributing over
+# threads
+_PAIR_THREAD_THRESHOLD = 100000
+
+
+def _lambdify(args, expr):
+  '''
+  converts `expr` into an elementwise numpy function of `args`.
+  Common subexpressions are evaluated only once, which substantially
+  reduces the arithmetic for derivatives of compound expressions. This
+  is the fallback when the expression cannot be compiled
+  '''
+  return sympy.lambdify(args, expr, modules='numpy', cse=True)
+
+
+def _as_pair_evaluator_from_ufunc(func):
+  '''
+  wraps an elementwise function of `(x0, ..., c0, ..., eps)` so that
+  it has the call signature `(x, c, eps) -> (n,) array`. Large
+  evaluations are split across threads, which write into disjoint
+  slices of the output while numpy releases the GIL
+  '''
+  def fill(out, x, c, eps, lo, hi):
+    args = tuple(x[lo:hi].T) + tuple(c[lo:hi].T) + (eps[lo:hi],)
+    out[lo:hi] = func(*args)
+
+  def evaluator(x, c, eps):
+    n = x.shape[0]
+    out = np.empty(n, dtype=float)
+    if n < _PAIR_THREAD_THRESHOLD:
+      fill(out, x, c, eps, 0, n)
+
+    else:
+      nthreads = os.cpu_count() or 1
+      bounds = np.linspace(0, n, nthreads + 1).astype(int)
+      with ThreadPoolExecutor(nthreads) as pool:
+        futures = [pool.submit(fill, out, x, c, eps, lo, hi)
+                   for lo, hi in zip(bounds[:-1], bounds[1:])]
+        # surface any exceptions raised by the workers, which would
+        # otherwise leave slices of `out` uninitialized without
+        # complaint
+        for future in futures:
+          future.result()
+
+    return out
+
+  return evaluator
+
+
+# template for the numba kernels generated by
+# `_compile_numba_r_kernel`. These kernels evaluate an expression of
+# `r` and `eps` over a precomputed (N, M) array of radial distances
+_NUMBA_R_KERNEL_TEMPLATE = '''
+import math
+from numba import njit, prange
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _kernel(r, eps, out):
+  for i in prange(r.shape[0]):
+    for j in range(r.shape[1]):
+      out[i, j] = %(expr)s
+'''
+
+
+def _compile_numba_r_kernel(expr):
+  '''
+  compiles `expr`, which is a function of `r` and `eps`, into a numba
+  kernel which evaluates the expression over an (N, M) array of
+  radial distances, with the signature `(r, eps, out)`
+  '''
+  mapping = {_R: sympy.Symbol('r[i, j]'), _EPS: sympy.Symbol('eps[j]')}
+  source = _NUMBA_R_KERNEL_TEMPLATE % {
+    'expr': sympy.printing.pycode(expr.xreplace(mapping))}
+
+  tempdir = _cache_dir()
+  modname = 'rbf_numba_r_kernel_%s' % _expr_key(expr)
+  fname = os.path.join(tempdir, '%s.py' % modname)
+  if not os.path.isfile(fname):
+    _publish_file(fname, source)
+
+  if tempdir not in sys.path:
+    sys.path.append(tempdir)
+
+  mod = importlib.import_module(modname)
+  return mod._kernel
+
+
+def _pairwise_r(x, c):
+  '''
+  returns the (N, M) array of distances between the points `x` and
+  the centers `c`
+  '''
+  # expand ||x - c||^2 as ||x||^2 + ||c||^2 - 2*x.c so that the cross
+  # term is a single matrix product, which avoids forming an
+  # (N, M, D) array of differences. Rounding can make the expansion
+  # slightly negative for nearly coincident points, so clamp it
+  r2 = (x*x).sum(1)[:, None] + (c*c).sum(1)[None, :] - 2.0*x.dot(c.T)
+  return np.sqrt(np.maximum(r2, 0.0, out=r2))
+
+
+def _as_dense_evaluator_from_r_kernel(kernel):
+  '''
+  wraps a numba kernel of `r` and `eps` so that it has the call
+  signature `(x, c, eps) -> (N, M) array`
+  '''
+  def evaluator(x, c, eps):
+    r = _pairwise_r(x, c)
+    out = np.empty(r.shape, dtype=r.dtype)
+    kernel(r, np.ascontiguousarray(eps), out)
+    return out
+
+  return evaluator
+
+
+def _as_dense_evaluator_from_r_ufunc(func):
+  '''
+  wraps an elementwise function of `r` and `eps` so that it has the
+  call signature `(x, c, eps) -> (N, M) array`
+  '''
+  def evaluator(x, c, eps):
+    return func(_pairwise_r(x, c), eps[None, :]).astype(x.dtype, copy=False)
+
+  return evaluator
+
+
+def _support_cond(expr):
+  '''
+  if `expr` is a Piecewise which is zero outside of a supported
+  region, as with the Wendland RBFs, returns the condition which is
+  true inside the support. Returns None otherwise
+  '''
+  if (isinstance(expr, sympy.Piecewise) and len(expr.args) == 2 and
+      expr.args[1].cond == sympy.true and expr.args[1].expr == 0):
+    return expr.args[0].cond
+
+  return None
+
+
+def _as_masked_dense_evaluator_from_r_ufunc(func, in_support):
+  '''
+  wraps an elementwise function of `r` and `eps` which is zero outside
+  of the support indicated by `in_support`. The function is evaluated
+  only at the pairs inside the support, which avoids the arithmetic
+  for the zero branch when most pairs are outside
+  '''
+  def evaluator(x, c, eps):
+    r = _pairwise_r(x, c)
+    eps = np.broadcast_to(eps[None, :], r.shape)
+    mask = in_support(r, eps)
+    out = np.zeros(r.shape, dtype=x.dtype)
+    out[mask] = func(r[mask], eps[mask])
+    return out
+
+  return evaluator
+
+
+# template for the C kernels generated by `_compile_c_kernel`. The
+# outer loop is distributed over threads and the inner loop is
+# vectorized, so each scalar operation in the expression maps to a
+# SIMD instruction rather than a temporary array
+_C_KERNEL_TEMPLATE = '''
+#include <math.h>
+
+void rbf_eval(long n, long m, const double *x, const double *c,
+              const double *eps, double *out)
+{
+  long i, j;
+  #pragma omp parallel for
+  for (i = 0; i < n; i++) {
+    #pragma omp simd
+    for (j = 0; j < m; j++) {
+      out[i*m + j] = %(expr)s;
+    }
+  }
+}
+'''
+
+
+def _compile_c_kernel(expr, x_sym, c_sym):
+  '''
+  compiles `expr`, which is a function of `x_sym`, `c_sym` and `eps`,
+  into a C kernel with the signature `(n, m, x, c, eps, out)`. The
+  shared library is saved on disk so that subsequent processes do not
+  need to recompile it
+  '''
+  dim = len(x_sym)
+  # replace the symbols with expressions indexing the kernel arguments
+  mapping = {_EPS: sympy.Symbol('eps[j]')}
+  mapping.update(
+    (xi, sympy.Symbol('x[i*%d + %d]' % (dim, d)))
+    for d, xi in enumerate(x_sym))
+  mapping.update(
+    (ci, sympy.Symbol('c[j*%d + %d]' % (dim, d)))
+    for d, ci in enumerate(c_sym))
+
+  tempdir = _compiled_ufunc_dir(expr)
+  os.makedirs(tempdir, exist_ok=True)
+  libname = os.path.join(tempdir, 'c_kernel_%s.so' % _host_key())
+  if not os.path.isfile(libname):
+    source = _C_KERNEL_TEMPLATE % {
+      'expr': sympy.ccode(expr.xreplace(mapping))}
+    srcname = os.path.join(tempdir, 'c_kernel.c')
+    _publish_file(srcname, source)
+
+    # compile to a temporary name and then rename it, so a concurrent
+    # process can never load a partially written library
+    fd, tmpname = tempfile.mkstemp(dir=tempdir, suffix='.so')
+    os.close(fd)
+    try:
+      subprocess.run(
+        ['cc', '-O3', '-march=native', '-ffast-math', '-fopenmp',
+         '-shared', '-fPIC', srcname, '-o', tmpname, '-lm'],
+        check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+      os.replace(tmpname, libname)
+    except BaseException:
+      os.unlink(tmpname)
+      raise
+
+  func = ctypes.CDLL(libname).rbf_eval
+  array_f8 = np.ctypeslib.ndpointer(dtype=float, flags='C_CONTIGUOUS')
+  func.argtypes = [ctypes.c_long, ctypes.c_long,
+                   array_f8, array_f8, array_f8, array_f8]
+  func.restype = None
+  return func
+
+
+def _as_dense_evaluator_from_cfunc(func):
+  '''
+  wraps a C kernel so that it allocates its own output array and has
+  the call signature `(x, c, eps) -> (N, M) array`
+  '''
+  def evaluator(x, c, eps):
+    # the C kernel is compiled for doubles, so cast the output back to
+    # the working precision if necessary
+    dtype = x.dtype
+    x = np.ascontiguousarray(x, dtype=float)
+    c = np.ascontiguousarray(c, dtype=float)
+    eps = np.ascontiguousarray(eps, dtype=float)
+    out = np.empty((x.shape[0], c.shape[0]), dtype=float)
+    func(x.shape[0], c.shape[0], x, c, eps, out)
+    return out.astype(dtype, copy=False)
+
+  return evaluator
+
+
+def _as_dense_evaluator(kernel):
+  '''
+  wraps a numba kernel so that it allocates its own output array and
+  has the call signature `(x, c, eps) -> (N, M) array`
+  '''
+  def evaluator(x, c, eps):
+    x = np.ascontiguousarray(x)
+    c = np.ascontiguousarray(c)
+    out = np.empty((x.shape[0], c.shape[0]), dtype=x.dtype)
+    kernel(x, c, eps, out)
+    return out
+
+  return evaluator
+
+
+def _as_dense_evaluator_from_ufunc(func):
+  '''
+  wraps an elementwise function of `(x0, ..., c0, ..., eps)` so that
+  it has the call signature `(x, c, eps) -> (N, M) array`
+  '''
+  def evaluator(x, c, eps):
+    args = tuple(x.T[:, :, None]) + tuple(c.T[:, None, :]) + (eps,)
+    return func(*args).astype(x.dtype, copy=False)
+
+  return evaluator
+
+
 class RBF(object):
   ''' 
   Stores a symbolic expression of a Radial Basis Function (RBF) and 
@@ -211,9 +740,12 @@ class RBF(object):
       
     self._limits = limits
     
-    ## create the cache for numerical functions    
+    ## create the cache for numerical functions
     self._cache = {}
 
+    ## create the cache for the values at the RBF center
+    self._lim_cache = {}
+
   def __call__(self, x, c, eps=1.0, diff=None):
     ''' 
     Numerically evaluates the RBF or its derivatives.
@@ -242,18 +774,27 @@ class RBF(object):
       The RBFs with centers `c` evaluated at `x`
 
     '''
-    x = np.asarray(x, dtype=float)
+    # evaluate with the common floating point precision of `x` and
+    # `c`, so that single precision inputs stay single precision
+    # end-to-end without silently downcasting either argument
+    x = np.asarray(x)
+    c = np.asarray(c)
+    dtype = np.result_type(x, c)
+    if not np.issubdtype(dtype, np.floating):
+      dtype = np.dtype(float)
+
+    x = np.asarray(x, dtype=dtype)
     assert_shape(x, (None, None), 'x')
 
-    c = np.asarray(c, dtype=float)
+    c = np.asarray(c, dtype=dtype)
     assert_shape(c, (None, x.shape[1]), 'c')
 
     # makes `eps` an array of constant values if it is a scalar
     if np.isscalar(eps):
-      eps = np.full(c.shape[0], eps, dtype=float)
+      eps = np.full(c.shape[0], eps, dtype=x.dtype)
 
-    else:  
-      eps = np.asarray(eps, dtype=float)
+    else:
+      eps = np.asarray(eps, dtype=x.dtype)
       assert_shape(eps, (c.shape[0],), 'eps')
 
     # if `diff` is not given then take no derivatives
@@ -269,25 +810,20 @@ class RBF(object):
     if diff not in self._cache:
       self._add_diff_to_cache(diff)
 
-    # expand to allow for broadcasting
-    x = x.T[:, :, None] 
-    c = c.T[:, None, :]
-    args = (tuple(x) + tuple(c) + (eps,))
-    # evaluate the cached function for the given `x`, `c`, and `eps
-    out = self._cache[diff](*args)
+    # evaluate the cached function for the given `x`, `c`, and `eps`
+    out = self._cache[diff](x, c, eps)
     return out
 
   def __repr__(self):
     out = '<RBF : %s>' % str(self.expr)
     return out
-     
-  def _add_diff_to_cache(self, diff):
-    '''     
-    Symbolically differentiates the RBF and then converts the
-    expression to a function which can be evaluated numerically.
-    '''   
-    logger.debug('Creating a numerical function for the RBF %s with '
-                 'the derivative %s ...' % (self,str(diff)))
+
+  def _diff_expr(self, diff):
+    '''
+    Symbolically differentiates the RBF according to `diff`. Returns
+    the differentiated expression along with the symbols for the
+    spatial variables and the centers
+    '''
     dim = len(diff)
     c_sym = sympy.symbols('c:%s' % dim)
     x_sym = sympy.symbols('x:%s' % dim)    
@@ -305,36 +841,182 @@ class RBF(object):
     # if `tol` is given, form a separate expression for the RBF near
     # its center
     if self.tol is not None:
-      if diff in self.limits:
-        # use a user-specified limit if available      
-        lim = self.limits[diff]
+      lim = self._compute_lim(diff, expr, x_sym, c_sym)
+      # create a piecewise symbolic function which is `lim` when
+      # `r_sym < tol` and `expr` otherwise
+      expr = sympy.Piecewise((lim, r_sym < self.tol), (expr, True))
+
+    return expr, x_sym, c_sym
+
+  def _compute_lim(self, diff, expr=None, x_sym=None, c_sym=None):
+    '''
+    Returns the value of the differentiated RBF at its center, taken
+    from `limits` if available and otherwise approximated by linearly
+    extrapolating the RBF from `r = tol` to `r = 0`. When the
+    cartesian symbols are not given, `expr` defaults to the RBF as a
+    function of `r`. The result is cached per `diff`
+    '''
+    if diff in self._lim_cache:
+      return self._lim_cache[diff]
+
+    if diff in self.limits:
+      # use a user-specified limit if available
+      lim = self.limits[diff]
 
-      else: 
-        logger.debug('Approximating the value at the RBF center ...')
+    else:
+      logger.debug('Approximating the value at the RBF center ...')
+      if x_sym is None:
+        # evaluate the RBF and its derivative w.r.t. `r` at `r = tol`
+        expr = self.expr if expr is None else expr
+        a = expr.subs(_R, self.tol)
+        b = expr.diff(_R).subs(_R, self.tol)
+
+      else:
         # evaluate the RBF at the point (x0=tol+c0, x1=c1, x2=c2, ...)
         subs_list  = [(x_sym[0], self.tol + c_sym[0])]
         subs_list += zip(x_sym[1:], c_sym[1:])
         # evaluate the RBF and its derivative w.r.t. x0 at that point
-        a = expr.subs(subs_list) 
+        a = expr.subs(subs_list)
         b = expr.diff(x_sym[0]).subs(subs_list)
-        # form a linear polynomial and evaluate it at x=c
-        lim = a - self.tol*b
-        # try to simplify the expression to reduce numerical rounding
-        # error. Note that this should only be a function of `eps` now
-        # and the simplification should not take long
-        lim = sympy.cancel(lim) 
-        # return any remaining numbers to regular precision floats
-        mapping = {n : float(n) for n in lim.atoms(sympy.Number)}
-        lim = sympy.sympify(lim.xreplace(mapping))
-        logger.debug('Approximate value at the RBF center: %s' % lim)
 
-      # create a piecewise symbolic function which is `lim` when
-      # `r_sym < tol` and `expr` otherwise
-      expr = sympy.Piecewise((lim, r_sym < self.tol), (expr, True)) 
-      
-    func = ufuncify(x_sym + c_sym + (_EPS,), expr, backend='numpy')
+      # form a linear polynomial and evaluate it at the center
+      lim = a - self.tol*b
+      # try to simplify the expression to reduce numerical rounding
+      # error. Note that this should only be a function of `eps` now
+      # and the simplification should not take long
+      lim = sympy.cancel(lim)
+      # return any remaining numbers to regular precision floats
+      mapping = {n : float(n) for n in lim.atoms(sympy.Number)}
+      lim = sympy.sympify(lim.xreplace(mapping))
+      logger.debug('Approximate value at the RBF center: %s' % lim)
+
+    self._lim_cache[diff] = lim
+    return lim
+
+  def _r_expr(self, diff):
+    '''
+    Returns the RBF expression as a function of `r` and `eps`. This is
+    only valid when `diff` indicates no derivatives, in which case the
+    expression does not need to be written in terms of the cartesian
+    variables
+    '''
+    expr = self.expr
+    if self.tol is not None:
+      lim = self._compute_lim(diff)
+      if sympy.sympify(lim) == 0:
+        # When the limit at the center is zero, try to avoid the
+        # Piecewise altogether, since it makes the generated kernel
+        # branch on every output element. Clamping `r` to a tiny
+        # positive value inside each logarithm keeps the expression
+        # finite at `r = 0`, where it is otherwise 0*log(0), and
+        # leaves every value at `r >= tiny` untouched. This is safe
+        # whenever the rewritten expression evaluates to the limit
+        # exactly at `r = 0`, which is the case for the polyharmonic
+        # splines
+        tiny = self.tol*sympy.Float(1e-3, 50)
+        safe = expr.replace(
+          lambda a: a.func == sympy.log,
+          lambda a: sympy.log(a.args[0].subs(_R, sympy.Max(_R, tiny))))
+        if safe.subs(_R, 0) == 0:
+          return safe
+
+      expr = sympy.Piecewise((lim, _R < self.tol), (expr, True))
+
+    return expr
+
+  def _func_cache_key(self, diff):
+    '''
+    Returns a hashable key identifying the numerical function for
+    `diff` in `_FUNC_CACHE`. Equivalent instances produce equal keys
+    '''
+    limits = tuple(
+      sorted((k, sympy.srepr(sympy.sympify(v)))
+             for k, v in self._limits.items()))
+    tol = None if self._tol is None else sympy.srepr(self._tol)
+    return (type(self).__name__, sympy.srepr(self._expr), tol,
+            limits, diff)
+
+  def _add_diff_to_cache(self, diff):
+    '''
+    Symbolically differentiates the RBF and then converts the
+    expression to a function which can be evaluated numerically. The
+    function is shared across equivalent instances via `_FUNC_CACHE`
+    '''
+    key = self._func_cache_key(diff)
+    func = _FUNC_CACHE.get(key)
+    if func is None:
+      func = self._make_numerical_func(diff)
+      _FUNC_CACHE[key] = func
+
     self._cache[diff] = func
-    logger.debug('The numerical function has been created and cached')
+
+  def _make_numerical_func(self, diff):
+    '''
+    Symbolically differentiates the RBF and then converts the
+    expression to a function which can be evaluated numerically.
+    '''
+    logger.debug('Creating a numerical function for the RBF %s with '
+                 'the derivative %s ...' % (self,str(diff)))
+    if all(d == 0 for d in diff):
+      # Without derivatives the RBF is a function of `r` alone, so
+      # evaluate it over a precomputed (N, M) distance array rather
+      # than making the kernel juggle the 2D+1 cartesian arguments
+      expr = self._r_expr(diff)
+      if _HAS_NUMBA:
+        try:
+          kernel = _compile_numba_r_kernel(expr)
+          return _as_dense_evaluator_from_r_kernel(kernel)
+
+        except Exception as err:
+          logger.debug(
+            'Failed to compile the RBF with numba: %s. Falling back '
+            'to an elementwise function' % err)
+
+      func = _lambdify((_R, _EPS), expr)
+      cond = _support_cond(self.expr)
+      if cond is not None:
+        # the RBF is zero outside of its support, so mask the
+        # distance matrix and evaluate only at the supported pairs.
+        # `expr` is zero wherever the mask is false, so this does not
+        # change the result
+        in_support = _lambdify((_R, _EPS), cond)
+        return _as_masked_dense_evaluator_from_r_ufunc(func, in_support)
+
+      return _as_dense_evaluator_from_r_ufunc(func)
+
+    expr, x_sym, c_sym = self._diff_expr(diff)
+
+    # If numba is available, compile the expression into a kernel
+    # which evaluates the RBF over `x` and `c` with a single fused and
+    # parallelized loop, avoiding all the (N, M) temporary arrays that
+    # elementwise evaluation creates
+    if _HAS_NUMBA:
+      try:
+        kernel = _compile_numba_kernel(expr, x_sym, c_sym)
+        return _as_dense_evaluator(kernel)
+
+      except Exception as err:
+        logger.debug(
+          'Failed to compile the RBF with numba: %s. Falling back to '
+          'an elementwise function' % err)
+
+    # Compile the expression into a C kernel which evaluates the
+    # expression with one vectorized and parallelized loop, rather
+    # than materializing an array for each subexpression like the
+    # numpy backend does. The shared library is saved on disk so that
+    # subsequent processes do not need to recompile it. Fall back to
+    # the numpy backend if compilation fails (e.g., no C compiler is
+    # available)
+    try:
+      func = _compile_c_kernel(expr, x_sym, c_sym)
+      return _as_dense_evaluator_from_cfunc(func)
+
+    except Exception as err:
+      logger.debug(
+        'Failed to compile the RBF to C: %s. Falling back to the '
+        'numpy backend' % err)
+      func = _lambdify(x_sym + c_sym + (_EPS,), expr)
+      return _as_dense_evaluator_from_ufunc(func)
     
   def clear_cache(self):
     ''' 
@@ -400,8 +1082,13 @@ class SparseRBF(RBF):
     if len(other_symbols) != 0:
       raise ValueError(
         '`supp` cannot contain any symbols other than `eps`')
-  
+
     self._supp = supp
+    # numerical support radii keyed by shape parameter
+    self._supp_cache = {}
+    # the KD-tree for the centers from the most recent call, keyed by
+    # the buffer of the centers array
+    self._ctree_cache = None
 
   def __call__(self, x, c, eps=1.0, diff=None):
     ''' 
@@ -456,142 +1143,165 @@ class SparseRBF(RBF):
     if diff not in self._cache:
       self._add_diff_to_cache(diff)
 
-    # convert self.supp from a sympy expression to a float
-    supp = float(self.supp.subs(_EPS, eps[0]))
+    # convert self.supp from a sympy expression to a float. The
+    # substitution is not cheap, so cache the result per shape
+    # parameter
+    try:
+      supp = self._supp_cache[eps[0]]
 
-    # find the nonzero entries based on distances between `x` and `c`
+    except KeyError:
+      supp = self._supp_cache[eps[0]] = float(self.supp.subs(_EPS, eps[0]))
+
+    # find the nonzero entries based on distances between `x` and `c`.
+    # `sparse_distance_matrix` builds the COO matrix in C++, which
+    # avoids looping over the centers in Python
     nx, nc = x.shape[0], c.shape[0]
     xtree = cKDTree(x)
-    ctree = cKDTree(c)
-    # `idx` contains the indices of `x` which are within
-    # `supp` of each node in `c`
-    idx = ctree.query_ball_tree(xtree, supp)
-
-    # total nonzero entries in the output array
-    nnz = sum(len(i) for i in idx)
-    # allocate sparse matrix data
-    data = np.zeros(nnz, dtype=float)
-    rows = np.zeros(nnz, dtype=int)
-    cols = np.zeros(nnz, dtype=int)
-    # `n` is the total number of data entries thus far
-    n = 0
-    for i, idxi in enumerate(idx):
-      # `m` is the number of nodes in `x` close to `c[[i]]`
-      m = len(idxi)
-      # properly shape `x` and `c` for broadcasting
-      xi = x.T[:, idxi, None]
-      ci = c.T[:, None, i][:, :, None]
-      args = (tuple(xi) + tuple(ci) + (eps,))
-      data[n:n + m] = self._cache[diff](*args)[:, 0]
-      rows[n:n + m] = idxi
-      cols[n:n + m] = i
-      n += m
-
-    # convert to a csc_matrix
-    out = csc_matrix((data, (rows, cols)), (nx, nc))
+    # reuse the tree for the centers if this is called repeatedly
+    # with the same array, which is common when assembling RBF-FD
+    # systems. The cache is keyed by the buffer address and shape, so
+    # mutating the centers in place will not be noticed
+    ckey = (c.__array_interface__['data'][0], c.shape)
+    if self._ctree_cache is not None and self._ctree_cache[0] == ckey:
+      ctree = self._ctree_cache[1]
+
+    else:
+      ctree = cKDTree(c)
+      self._ctree_cache = (ckey, ctree)
+
+    D = ctree.sparse_distance_matrix(xtree, supp, output_type='coo_matrix')
+    # `ctree` is the query side, so its indices are the rows of `D`
+    # and the columns of the output
+    rows, cols = D.col, D.row
+
+    # evaluate the RBF for all the nonzero entries with a single call.
+    # The kernel gathers the points and centers itself, so only the
+    # nnz-length output is allocated
+    eps = np.full(nc, eps[0], dtype=float)
+    data = self._cache[diff](rows, cols, x, c, eps)
+
+    # convert to a csc_matrix. The entries normally come back from
+    # `sparse_distance_matrix` already grouped by center, in which
+    # case the CSC arrays can be assembled directly instead of going
+    # through the COO constructor, which sorts the triplets
+    if np.all(np.diff(cols) >= 0):
+      indptr = np.empty(nc + 1, dtype=np.intp)
+      indptr[0] = 0
+      np.cumsum(np.bincount(cols, minlength=nc), out=indptr[1:])
+      out = csc_matrix((data, rows, indptr), (nx, nc))
+
+    else:
+      out = csc_matrix((data, (rows, cols)), (nx, nc))
+
     return out
 
+  def _make_numerical_func(self, diff):
+    '''
+    Symbolically differentiates the RBF and then converts the
+    expression to a function which evaluates the RBF for paired
+    points and centers.
+    '''
+    logger.debug('Creating a numerical function for the RBF %s with '
+                 'the derivative %s ...' % (self,str(diff)))
+    expr, x_sym, c_sym = self._diff_expr(diff)
+    if _HAS_NUMBA:
+      try:
+        kernel = _compile_numba_gather_kernel(expr, x_sym, c_sym)
+        return _as_gather_evaluator(kernel)
+
+      except Exception as err:
+        logger.debug(
+          'Failed to compile the RBF with numba: %s. Falling back to '
+          'an elementwise function' % err)
+
+    func = _lambdify(x_sym + c_sym + (_EPS,), expr)
+    return _as_gather_evaluator_from_pairs(
+      _as_pair_evaluator_from_ufunc(func))
+
   def __repr__(self):
-    out = ('<SparseRBF : %s (support = %s)>' % 
+    out = ('<SparseRBF : %s (support = %s)>' %
            (str(self.expr), str(self.supp)))
     return out
 
   
 ## Instantiate some common RBFs
 #####################################################################
-_phs8_limits = {}
-_phs8_limits.update((tuple(i), 0) for i in powers(7, 1))
-_phs8_limits.update((tuple(i), 0) for i in powers(7, 2))
-_phs8_limits.update((tuple(i), 0) for i in powers(7, 3))
-phs8 = RBF((_EPS*_R)**8*sympy.log(_EPS*_R), tol=1e-10, limits=_phs8_limits)
-
-_phs7_limits = {}
-_phs7_limits.update((tuple(i), 0) for i in powers(6, 1))
-_phs7_limits.update((tuple(i), 0) for i in powers(6, 2))
-_phs7_limits.update((tuple(i), 0) for i in powers(6, 3))
-phs7 = RBF((_EPS*_R)**7, tol=1e-10, limits=_phs7_limits)
-
-_phs6_limits = {}
-_phs6_limits.update((tuple(i), 0) for i in powers(5, 1))
-_phs6_limits.update((tuple(i), 0) for i in powers(5, 2))
-_phs6_limits.update((tuple(i), 0) for i in powers(5, 3))
-phs6 = RBF((_EPS*_R)**6*sympy.log(_EPS*_R), tol=1e-10, limits=_phs6_limits)
+# limits dictionaries shared across the polyharmonic splines with the
+# same order
+_PHS_LIMITS_CACHE = {}
 
-_phs5_limits = {}
-_phs5_limits.update((tuple(i), 0) for i in powers(4, 1))
-_phs5_limits.update((tuple(i), 0) for i in powers(4, 2))
-_phs5_limits.update((tuple(i), 0) for i in powers(4, 3))
-phs5 = RBF((_EPS*_R)**5, tol=1e-10, limits=_phs5_limits)
 
-_phs4_limits = {}
-_phs4_limits.update((tuple(i), 0) for i in powers(3, 1))
-_phs4_limits.update((tuple(i), 0) for i in powers(3, 2))
-_phs4_limits.update((tuple(i), 0) for i in powers(3, 3))
-phs4 = RBF((_EPS*_R)**4*sympy.log(_EPS*_R), tol=1e-10, limits=_phs4_limits)
-
-_phs3_limits = {}
-_phs3_limits.update((tuple(i), 0) for i in powers(2, 1))
-_phs3_limits.update((tuple(i), 0) for i in powers(2, 2))
-_phs3_limits.update((tuple(i), 0) for i in powers(2, 3))
-phs3 = RBF((_EPS*_R)**3, tol=1e-10, limits=_phs3_limits)
-
-_phs2_limits = {}
-_phs2_limits.update((tuple(i), 0) for i in powers(1, 1))
-_phs2_limits.update((tuple(i), 0) for i in powers(1, 2))
-_phs2_limits.update((tuple(i), 0) for i in powers(1, 3))
-phs2 = RBF((_EPS*_R)**2*sympy.log(_EPS*_R), tol=1e-10, limits=_phs2_limits)
-
-_phs1_limits = {}
-_phs1_limits.update((tuple(i), 0) for i in powers(0, 1))
-_phs1_limits.update((tuple(i), 0) for i in powers(0, 2))
-_phs1_limits.update((tuple(i), 0) for i in powers(0, 3))
-phs1 = RBF(_EPS*_R, tol=1e-10, limits=_phs1_limits)
-
-# inverse multiquadratic
-imq = RBF(1/sympy.sqrt(1 + (_EPS*_R)**2))
-
-# inverse quadratic
-iq = RBF(1/(1 + (_EPS*_R)**2))
-
-# Gaussian
-ga = RBF(sympy.exp(-(_EPS*_R)**2))
-
-# multiquadratic
-mq = RBF(sympy.sqrt(1 + (_EPS*_R)**2))
-
-# exponential
-exp = RBF(sympy.exp(-_R/_EPS))
-
-# squared exponential
-se = RBF(sympy.exp(-_R**2/(2*_EPS**2)))
-
-# Matern
-mat32 = RBF((1 + sympy.sqrt(3)*_R/_EPS)                       * sympy.exp(-sympy.sqrt(3)*_R/_EPS), tol=1e-8*_EPS)
-
-mat52 = RBF((1 + sympy.sqrt(5)*_R/_EPS + 5*_R**2/(3*_EPS**2)) * sympy.exp(-sympy.sqrt(5)*_R/_EPS), tol=1e-6*_EPS)
-
-# Wendland 
-wen10 = RBF(sympy.Piecewise(((1 - _R/_EPS)                                         , _R < _EPS), (0.0, True)), tol=1e-8*_EPS)
-
-wen11 = RBF(sympy.Piecewise(((1 - _R/_EPS)**3*(3*_R/_EPS + 1)                      , _R < _EPS), (0.0, True)), tol=1e-8*_EPS) 
-
-wen12 = RBF(sympy.Piecewise(((1 - _R/_EPS)**5*(8*_R**2/_EPS**2 + 5*_R/_EPS + 1)    , _R < _EPS), (0.0, True)), tol=1e-3*_EPS) 
-
-wen30 = RBF(sympy.Piecewise(((1 - _R/_EPS)**2                                      , _R < _EPS), (0.0, True)), tol=1e-8*_EPS)  
-
-wen31 = RBF(sympy.Piecewise(((1 - _R/_EPS)**4*(4*_R/_EPS + 1)                      , _R < _EPS), (0.0, True)), tol=1e-8*_EPS) 
-    
-wen32 = RBF(sympy.Piecewise(((1 - _R/_EPS)**6*(35*_R**2/_EPS**2 + 18*_R/_EPS + 3)/3, _R < _EPS), (0.0, True)), tol=1e-3*_EPS) 
-
-# sparse Wendland 
-spwen10 = SparseRBF(         (1 - _R/_EPS)                                         , _EPS, tol=1e-8*_EPS)
-
-spwen11 = SparseRBF(         (1 - _R/_EPS)**3*(3*_R/_EPS + 1)                      , _EPS, tol=1e-8*_EPS)
-
-spwen12 = SparseRBF(         (1 - _R/_EPS)**5*(8*_R**2/_EPS**2 + 5*_R/_EPS + 1)    , _EPS, tol=1e-3*_EPS)
-
-spwen30 = SparseRBF(         (1 - _R/_EPS)**2                                      , _EPS, tol=1e-8*_EPS)
-
-spwen31 = SparseRBF(         (1 - _R/_EPS)**4*(4*_R/_EPS + 1)                      , _EPS, tol=1e-8*_EPS)
+def _phs_limits(order):
+  '''
+  returns the limits dictionary for a polyharmonic spline, indicating
+  that the spline and its derivatives up to `order` are zero at the
+  center for one, two and three spatial dimensions
+  '''
+  if order not in _PHS_LIMITS_CACHE:
+    # freeze the dictionary since it is shared across instances
+    _PHS_LIMITS_CACHE[order] = types.MappingProxyType(dict.fromkeys(
+      (tuple(p) for d in (1, 2, 3) for p in powers(order, d)), 0))
+
+  return _PHS_LIMITS_CACHE[order]
+
+
+# factories for the predefined RBFs. Each instance is built on first
+# attribute access through the module-level `__getattr__` below, so
+# importing this module does not run the symbolic setup for RBFs that
+# are never used
+_PREDEFINED = {
+  # polyharmonic splines
+  'phs8': lambda: RBF((_EPS*_R)**8*sympy.log(_EPS*_R), tol=1e-10, limits=_phs_limits(7)),
+  'phs7': lambda: RBF((_EPS*_R)**7, tol=1e-10, limits=_phs_limits(6)),
+  'phs6': lambda: RBF((_EPS*_R)**6*sympy.log(_EPS*_R), tol=1e-10, limits=_phs_limits(5)),
+  'phs5': lambda: RBF((_EPS*_R)**5, tol=1e-10, limits=_phs_limits(4)),
+  'phs4': lambda: RBF((_EPS*_R)**4*sympy.log(_EPS*_R), tol=1e-10, limits=_phs_limits(3)),
+  'phs3': lambda: RBF((_EPS*_R)**3, tol=1e-10, limits=_phs_limits(2)),
+  'phs2': lambda: RBF((_EPS*_R)**2*sympy.log(_EPS*_R), tol=1e-10, limits=_phs_limits(1)),
+  'phs1': lambda: RBF(_EPS*_R, tol=1e-10, limits=_phs_limits(0)),
+  # inverse multiquadratic
+  'imq': lambda: RBF(1/sympy.sqrt(1 + (_EPS*_R)**2)),
+  # inverse quadratic
+  'iq': lambda: RBF(1/(1 + (_EPS*_R)**2)),
+  # Gaussian
+  'ga': lambda: RBF(sympy.exp(-(_EPS*_R)**2)),
+  # multiquadratic
+  'mq': lambda: RBF(sympy.sqrt(1 + (_EPS*_R)**2)),
+  # exponential
+  'exp': lambda: RBF(sympy.exp(-_R/_EPS)),
+  # squared exponential
+  'se': lambda: RBF(sympy.exp(-_R**2/(2*_EPS**2))),
+  # Matern
+  'mat32': lambda: RBF((1 + sympy.sqrt(3)*_R/_EPS)                       * sympy.exp(-sympy.sqrt(3)*_R/_EPS), tol=1e-8*_EPS),
+  'mat52': lambda: RBF((1 + sympy.sqrt(5)*_R/_EPS + 5*_R**2/(3*_EPS**2)) * sympy.exp(-sympy.sqrt(5)*_R/_EPS), tol=1e-6*_EPS),
+  # Wendland
+  'wen10': lambda: RBF(sympy.Piecewise(((1 - _R/_EPS)                                         , _R < _EPS), (0.0, True)), tol=1e-8*_EPS),
+  'wen11': lambda: RBF(sympy.Piecewise(((1 - _R/_EPS)**3*(3*_R/_EPS + 1)                      , _R < _EPS), (0.0, True)), tol=1e-8*_EPS),
+  'wen12': lambda: RBF(sympy.Piecewise(((1 - _R/_EPS)**5*(8*_R**2/_EPS**2 + 5*_R/_EPS + 1)    , _R < _EPS), (0.0, True)), tol=1e-3*_EPS),
+  'wen30': lambda: RBF(sympy.Piecewise(((1 - _R/_EPS)**2                                      , _R < _EPS), (0.0, True)), tol=1e-8*_EPS),
+  'wen31': lambda: RBF(sympy.Piecewise(((1 - _R/_EPS)**4*(4*_R/_EPS + 1)                      , _R < _EPS), (0.0, True)), tol=1e-8*_EPS),
+  'wen32': lambda: RBF(sympy.Piecewise(((1 - _R/_EPS)**6*(35*_R**2/_EPS**2 + 18*_R/_EPS + 3)/3, _R < _EPS), (0.0, True)), tol=1e-3*_EPS),
+  # sparse Wendland
+  'spwen10': lambda: SparseRBF(         (1 - _R/_EPS)                                         , _EPS, tol=1e-8*_EPS),
+  'spwen11': lambda: SparseRBF(         (1 - _R/_EPS)**3*(3*_R/_EPS + 1)                      , _EPS, tol=1e-8*_EPS),
+  'spwen12': lambda: SparseRBF(         (1 - _R/_EPS)**5*(8*_R**2/_EPS**2 + 5*_R/_EPS + 1)    , _EPS, tol=1e-3*_EPS),
+  'spwen30': lambda: SparseRBF(         (1 - _R/_EPS)**2                                      , _EPS, tol=1e-8*_EPS),
+  'spwen31': lambda: SparseRBF(         (1 - _R/_EPS)**4*(4*_R/_EPS + 1)                      , _EPS, tol=1e-8*_EPS),
+  'spwen32': lambda: SparseRBF(         (1 - _R/_EPS)**6*(35*_R**2/_EPS**2 + 18*_R/_EPS + 3)/3, _EPS, tol=1e-3*_EPS),
+  }
+
+
+__all__ = ['RBF', 'SparseRBF', 'get_r', 'get_eps'] + sorted(_PREDEFINED)
+
+
+def __getattr__(name):
+  '''
+  builds the predefined RBFs on first access (PEP 562)
+  '''
+  if name in _PREDEFINED:
+    inst = _PREDEFINED[name]()
+    globals()[name] = inst
+    return inst
 
-spwen32 = SparseRBF(         (1 - _R/_EPS)**6*(35*_R**2/_EPS**2 + 18*_R/_EPS + 3)/3, _EPS, tol=1e-3*_EPS)
+  raise AttributeError(
+    'module %r has no attribute %r' % (__name__, name))
@@ -347,6 +347,146 @@ def weight_matrix(x, p, diffs, coeffs=None,
   return L
                 
 
+def weight_matrices(x, p, diffs_list, coeffs_list=None,
+                    basis=rbf.basis.phs3, order=None,
+                    eps=1.0, n=None, stencils=None):
+  '''
+  Returns a weight matrix for each differential operator in
+  `diffs_list`. This is equivalent to calling `weight_matrix` once per
+  operator, except that the stencils, the stencil systems, and their
+  factorizations are built once and shared across all the operators.
+  Use this when several weight matrices are needed over the same
+  points, since the cost of the local linear solves is then paid only
+  once.
+
+  Parameters
+  ----------
+  x : (N, D) array
+    Target points.
+
+  p : (M, D) array
+    Source points. The stencils will be made up of these points.
+
+  diffs_list : sequence of (D,) or (K, D) int arrays
+    The derivative orders for each differential operator. See
+    `weight_matrix` for the format of each entry.
+
+  coeffs_list : sequence of (K,) or (K, N) float arrays, optional
+    Coefficients for each term in each differential operator. Each
+    entry corresponds to an entry in `diffs_list` and defaults to an
+    array of ones.
+
+  basis, order, eps, n, stencils : optional
+    See `weight_matrix`. When not given, `order` and `n` default to
+    the largest of the per-operator defaults, so that every stencil
+    is large enough for all the operators.
+
+  Returns
+  -------
+  list of (N, M) csc sparse matrices
+
+  '''
+  x = np.asarray(x, dtype=float)
+  assert_shape(x, (None, None), 'x')
+
+  p = np.asarray(p, dtype=float)
+  assert_shape(p, (None, x.shape[1]), 'p')
+
+  diffs_list = [_reshape_diffs(np.asarray(d, dtype=int))
+                for d in diffs_list]
+
+  if np.isscalar(eps):
+    eps = np.full(p.shape[0], eps, dtype=float)
+  else:
+    eps = np.asarray(eps, dtype=float)
+    assert_shape(eps, (p.shape[0],), 'eps')
+
+  # make each entry of `coeffs_list` a (K, N) array
+  if coeffs_list is None:
+    coeffs_list = [np.ones((d.shape[0], x.shape[0]), dtype=float)
+                   for d in diffs_list]
+  else:
+    coeffs_list = [np.asarray(c, dtype=float) for c in coeffs_list]
+    coeffs_list = [np.repeat(c[:, None], x.shape[0], axis=1)
+                   if c.ndim == 1 else c
+                   for c in coeffs_list]
+    for c, d in zip(coeffs_list, diffs_list):
+      assert_shape(c, (d.shape[0], x.shape[0]), 'coeffs')
+
+  if stencils is None:
+    if n is None:
+      # use a stencil size sufficient for every operator
+      n = max(_default_stencil_size(d) for d in diffs_list)
+      n = min(n, p.shape[0])
+
+    stencils = rbf.stencil.stencil_network(x, p, n)
+  else:
+    stencils = np.asarray(stencils, dtype=int)
+    assert_shape(stencils, (x.shape[0], None), 'stencils')
+
+  max_order = _max_poly_order(stencils.shape[1], x.shape[1])
+  if order is None:
+    # use a polynomial order sufficient for every operator
+    order = max(_default_poly_order(d) for d in diffs_list)
+    order = min(order, max_order)
+
+  if order > max_order:
+    raise ValueError('Polynomial order is too high for the stencil size')
+
+  logger.debug(
+    'building %s (%s, %s) RBF-FD weight matrices with %s nonzeros '
+    'each...'
+    % (len(diffs_list), x.shape[0], p.shape[0], stencils.size))
+
+  # values that will be put into the sparse matrices
+  data = [np.zeros(stencils.shape, dtype=float) for d in diffs_list]
+  powers = rbf.poly.powers(order, x.shape[1])
+  for i, si in enumerate(stencils):
+    # intermittently log the progress
+    if i % max(stencils.shape[0] // 10, 1) == 0:
+      logger.debug('  %d%% complete' % (100*i / stencils.shape[0]))
+
+    xi, s = x[i], p[si]
+    # evaluate the RBF and monomials at each point in the stencil.
+    # This becomes the left-hand-side, which is shared by all the
+    # operators
+    A = basis(s, s, eps=eps[si])
+    P = rbf.poly.mvmonos(s, powers)
+    # evaluate the RBF and monomials for each operator. Each operator
+    # contributes one column to the right-hand-sides
+    a = np.zeros((s.shape[0], len(diffs_list)), dtype=float)
+    pm = np.zeros((powers.shape[0], len(diffs_list)), dtype=float)
+    for k, (diffs, coeffs) in enumerate(zip(diffs_list, coeffs_list)):
+      for c, d in zip(coeffs[:, i], diffs):
+        a[:, k] += c*rbf.linalg.as_array(
+          basis(xi[None, :], s, eps=eps[si], diff=d))[0]
+        pm[:, k] += c*rbf.poly.mvmonos(xi[None, :], powers, diff=d)[0]
+
+    # attempt to compute the RBF-FD weights for all the operators
+    # with a single factorization of the stencil system
+    try:
+      w = PartitionedSolver(A, P).solve(a, pm)[0]
+
+    except np.linalg.LinAlgError:
+      raise np.linalg.LinAlgError(
+        'An error was raised while computing the RBF-FD weights at '
+        'point %s with the RBF %s and the polynomial order %s. This '
+        'may be due to a stencil with duplicate or collinear points. '
+        'The stencil contains the following points:\n%s' %
+        (xi, basis, order, s))
+
+    for k in range(len(diffs_list)):
+      data[k][i, :] = w[:, k]
+
+  rows = np.repeat(range(stencils.shape[0]), stencils.shape[1])
+  cols = stencils.ravel()
+  shape = x.shape[0], p.shape[0]
+  out = [sp.csc_matrix((d.ravel(), (rows, cols)), shape)
+         for d in data]
+  logger.debug('  done')
+  return out
+
+
 def add_rows(A, B, idx):
   '''
   This function effectively returns `A` after the operation `A[idx, :]
@@ -7,6 +7,7 @@ import warnings
 import numpy as np
 import scipy.sparse as sp
 import scipy.sparse.linalg as spla
+from scipy.linalg.blas import dsyrk
 from scipy.linalg.lapack import (dpotrf, dpotrs, dtrtrs, dgetrf,
                                  dgetrs)
 
@@ -67,7 +68,7 @@ def _lu(A):
   return fac, piv
 
 
-def _solve_lu(fac, piv, b):
+def _solve_lu(fac, piv, b, overwrite_b=False):
   '''
   Solves the system of equations `Ax = b` given the LU factorization
   of `A`. Uses the `dgetrs` routine.
@@ -77,16 +78,19 @@ def _solve_lu(fac, piv, b):
   fac : (N, N) float array
   piv : (N,) int array
   b : (N, *) float array
+  overwrite_b : bool, optional
+    Whether `b` can be destroyed, which avoids an internal copy
 
   Returns
   -------
   (N, *) float array
   '''
-  # handle the case of an array with zero-length for an axis.
+  # handle the case of an array with zero-length for an axis. The
+  # result has no elements, so it does not need to be zeroed
   if any(i == 0 for i in b.shape):
-    return np.zeros(b.shape)
+    return np.empty(b.shape, dtype=float)
 
-  x, info = dgetrs(fac, piv, b)
+  x, info = dgetrs(fac, piv, b, overwrite_b=overwrite_b)
   if info != 0:
     raise ValueError(
       'the %s-th argument had an illegal value' % -info)
@@ -125,7 +129,7 @@ def _cholesky(A, lower=True):
   return L
 
 
-def _solve_cholesky(L, b, lower=True):
+def _solve_cholesky(L, b, lower=True, overwrite_b=False):
   ''' 
   Solves the system of equations `Ax = b` given the Cholesky
   decomposition of `A`. Uses the routine `dpotrs`.
@@ -134,15 +138,17 @@ def _solve_cholesky(L, b, lower=True):
   ----------
   L : (N, N) float array
   b : (N, *) float array
+  overwrite_b : bool, optional
+    Whether `b` can be destroyed, which avoids an internal copy
 
   Returns
   -------
   (N, *) float array
   '''
   if any(i == 0 for i in b.shape):
-    return np.zeros(b.shape)
+    return np.empty(b.shape, dtype=float)
 
-  x, info = dpotrs(L, b, lower=lower)
+  x, info = dpotrs(L, b, lower=lower, overwrite_b=overwrite_b)
   if info < 0:
     raise ValueError(
       'The %s-th argument has an illegal value.' % -info)
@@ -150,7 +156,7 @@ def _solve_cholesky(L, b, lower=True):
   return x
   
 
-def _solve_triangular(L, b, lower=True):
+def _solve_triangular(L, b, lower=True, overwrite_b=False):
   ''' 
   Solve the triangular system of equations `Lx = b` using `dtrtrs`.
 
@@ -158,15 +164,17 @@ def _solve_triangular(L, b, lower=True):
   ----------
   L : (N, N) float array
   b : (N, *) float array
+  overwrite_b : bool, optional
+    Whether `b` can be destroyed, which avoids an internal copy
 
   Returns
   -------
   (N, *) float array
   '''
   if any(i == 0 for i in b.shape):
-    return np.zeros(b.shape)
+    return np.empty(b.shape, dtype=float)
 
-  x, info = dtrtrs(L, b, lower=lower)
+  x, info = dtrtrs(L, b, lower=lower, overwrite_b=overwrite_b)
   if info < 0:
     raise ValueError(
       'The %s-th argument had an illegal value' % (-info))
@@ -182,13 +190,16 @@ def _solve_triangular(L, b, lower=True):
 
 #####################################################################
 def as_sparse_or_array(A, dtype=None, copy=False):
-  ''' 
+  '''
   If `A` is a scipy sparse matrix then return it as a csc matrix.
   Otherwise, return it as an array.
   '''
   if sp.issparse(A):
-    # This does not make a copy if A is csc, has the same dtype and
-    # copy is false.
+    if (isinstance(A, sp.csc_matrix) and not copy and
+        (dtype is None or A.dtype == dtype)):
+      # `A` is already what the caller wants
+      return A
+
     A = sp.csc_matrix(A, dtype=dtype, copy=copy)
 
   else:
@@ -198,12 +209,24 @@ def as_sparse_or_array(A, dtype=None, copy=False):
 
 
 def as_array(A, dtype=None, copy=False):
-  ''' 
+  '''
   Return `A` as an array if it is not already. This properly handles
   when `A` is sparse.
   '''
+  if (isinstance(A, np.ndarray) and not copy and
+      (dtype is None or A.dtype == dtype)):
+    # `A` is already what the caller wants, skip the dtype check and
+    # potential copy that `np.array` does on every call
+    return A
+
   if sp.issparse(A):
+    # `toarray` returns a fresh array, so at most a dtype conversion
+    # is needed
     A = A.toarray()
+    if dtype is not None and A.dtype != dtype:
+      A = A.astype(dtype)
+
+    return A
 
   A = np.array(A, dtype=dtype, copy=copy)
   return A
@@ -212,16 +235,20 @@ def as_array(A, dtype=None, copy=False):
 class _SparseSolver(object):
   '''
   computes the LU factorization of the sparse matrix `A` with SuperLU.
+  A fill-reducing column ordering is applied before factoring, which
+  keeps the L and U factors sparse and makes each subsequent solve
+  cheaper.
   '''
-  def __init__(self, A):
+  def __init__(self, A, permc_spec='COLAMD'):
     LOGGER.debug('computing the LU decomposition of a %s by %s '
-                 'sparse matrix with %s nonzeros ' % 
+                 'sparse matrix with %s nonzeros ' %
                  (A.shape + (A.nnz,)))
-    self.factor = spla.spilu(A)
+    self.factor = spla.splu(A, permc_spec=permc_spec)
 
-  def solve(self, b):
+  def solve(self, b, overwrite_b=False):
     ''' 
-    solves `Ax = b` for `x`
+    solves `Ax = b` for `x`. `overwrite_b` is ignored since SuperLU
+    does not write into `b`
     '''
     return self.factor.solve(b)
 
@@ -235,11 +262,11 @@ class _DenseSolver(object):
     self.fac = fac
     self.piv = piv
 
-  def solve(self, b):
+  def solve(self, b, overwrite_b=False):
     ''' 
     solves `Ax = b` for `x`
     '''
-    return _solve_lu(self.fac, self.piv, b)     
+    return _solve_lu(self.fac, self.piv, b, overwrite_b=overwrite_b)
   
 
 class Solver(object):
@@ -247,33 +274,41 @@ class Solver(object):
   Computes an LU factorization of `A` and provides a method to solve
   `Ax = b` for `x`. `A` can be a scipy sparse matrix or a numpy array.
   '''
-  def __init__(self, A):
-    ''' 
+  def __init__(self, A, permc_spec='COLAMD'):
+    '''
     Parameters
     ----------
-    A : (N, N) array or scipy sparse matrix 
+    A : (N, N) array or scipy sparse matrix
+
+    permc_spec : str, optional
+      Fill-reducing column ordering used when `A` is sparse. See
+      `scipy.sparse.linalg.splu` for the available orderings
     '''
-    A = as_sparse_or_array(A, dtype=float)    
+    A = as_sparse_or_array(A, dtype=float)
     if sp.issparse(A):
-      self._solver =  _SparseSolver(A)
+      self._solver =  _SparseSolver(A, permc_spec=permc_spec)
 
-    else:  
-      self._solver = _DenseSolver(A)           
+    else:
+      self._solver = _DenseSolver(A)
     
-  def solve(self, b):
+  def solve(self, b, overwrite_b=False):
     '''
     solves `Ax = b` for `x`
     
     Parameters
     ----------
     b : (N, *) array or sparse matrix
+
+    overwrite_b : bool, optional
+      Whether `b` can be destroyed, which can save a copy. Only set
+      this when the caller owns `b`
     
     Returns
     -------
     out : (N, *) array
     '''
     b = as_array(b, dtype=float)
-    return self._solver.solve(b)
+    return self._solver.solve(b, overwrite_b=overwrite_b)
   
     
 class _SparsePosDefSolver(object):
@@ -292,39 +327,55 @@ class _SparsePosDefSolver(object):
                                    ordering_method='default')
     # store the squared diagonal components of the cholesky
     # factorization
-    self.d = self.factor.D() 
+    self.d = self.factor.D()
+    # CHOLMOD only raises CholmodNotPositiveDefiniteError for a zero
+    # diagonal entry when it picks a simplicial LDLt factorization. A
+    # negative entry "succeeds", so catch it here rather than letting
+    # it turn into NaNs in the solves
+    if not np.all(self.d > 0):
+      raise cholmod.CholmodNotPositiveDefiniteError(
+        'the matrix is not positive definite')
+
+    self._sqrt_d_inv = 1.0/np.sqrt(self.d)
     # store the permutation array, which permutes `A` such that its
-    # cholesky factorization is maximally sparse
+    # cholesky factorization is maximally sparse, along with its
+    # inverse
     self.p = self.factor.P()
+    self._p_inv = np.empty_like(self.p)
+    self._p_inv[self.p] = np.arange(self.p.size, dtype=self.p.dtype)
 
-  def solve(self, b):
+  def solve(self, b, overwrite_b=False):
     ''' 
-    solves `Ax = b` for `x`
+    solves `Ax = b` for `x`. `overwrite_b` is ignored since CHOLMOD
+    does not write into `b`
     '''
     return self.factor.solve_A(b)
 
-  def solve_L(self, b):
+  def solve_L(self, b, overwrite_b=False):
     ''' 
-    Solves `Lx = b` for `x`
+    Solves `Lx = b` for `x`. `overwrite_b` is ignored since CHOLMOD
+    does not write into `b`
     '''
     if b.ndim == 1:
-      s_inv = 1.0/np.sqrt(self.d)
+      s_inv = self._sqrt_d_inv
 
     elif b.ndim == 2:
       # expand for broadcasting
-      s_inv = 1.0/np.sqrt(self.d)[:, None]
+      s_inv = self._sqrt_d_inv[:, None]
 
     else:
       raise ValueError('`b` must be a one or two dimensional array')
 
-    out = s_inv*self.factor.solve_L(b[self.p])
+    # `solve_L` returns a fresh array that we own, so scale it in
+    # place rather than allocating another temporary
+    out = self.factor.solve_L(b[self.p])
+    out *= s_inv
     return out
 
   def L(self):
     '''Return the factorization `L`'''
     L = self.factor.L()
-    p_inv = np.argsort(self.p)
-    out = L[p_inv]
+    out = L[self._p_inv]
     return out
 
   def log_det(self):
@@ -341,18 +392,20 @@ class _DensePosDefSolver(object):
   def __init__(self, A):
     self.chol = _cholesky(A, lower=True)
 
-  def solve(self, b):
+  def solve(self, b, overwrite_b=False):
     ''' 
     Solves the equation `Ax = b` for `x`
     '''
-    return _solve_cholesky(self.chol, b, lower=True)
+    return _solve_cholesky(self.chol, b, lower=True,
+                           overwrite_b=overwrite_b)
 
-  def solve_L(self, b):
+  def solve_L(self, b, overwrite_b=False):
     ''' 
     Solves the equation `Lx = b` for `x`, where `L` is the Cholesky
     decomposition.
     '''
-    return _solve_triangular(self.chol, b, lower=True)
+    return _solve_triangular(self.chol, b, lower=True,
+                             overwrite_b=overwrite_b)
 
   def L(self):
     '''Returns the Cholesky decomposition of `A`'''
@@ -389,35 +442,43 @@ class PosDefSolver(object):
     else:  
       self._solver = _DensePosDefSolver(A)           
 
-  def solve(self, b):
+  def solve(self, b, overwrite_b=False):
     '''
     solves `Ax = b` for `x`
     
     Parameters
     ----------
     b : (N, *) array or sparse matrix
+
+    overwrite_b : bool, optional
+      Whether `b` can be destroyed, which can save a copy. Only set
+      this when the caller owns `b`
     
     Returns
     -------
     out : (N, *) array
     '''
     b = as_array(b, dtype=float)
-    return self._solver.solve(b)
+    return self._solver.solve(b, overwrite_b=overwrite_b)
 
-  def solve_L(self, b):
+  def solve_L(self, b, overwrite_b=False):
     '''
     solves `Lx = b` for `x`
     
     Parameters
     ----------
     b : (N, *) array or sparse matrix
+
+    overwrite_b : bool, optional
+      Whether `b` can be destroyed, which can save a copy. Only set
+      this when the caller owns `b`
     
     Returns
     -------
     out : (N, *) array
     '''
     b = as_array(b, dtype=float)
-    return self._solver.solve_L(b)
+    return self._solver.solve_L(b, overwrite_b=overwrite_b)
 
   def L(self):
     '''
@@ -441,18 +502,24 @@ class PosDefSolver(object):
 
 
 def is_positive_definite(A):
-  ''' 
+  '''
   Tests if *A* is positive definite. This is done by testing whether
   the Cholesky decomposition finishes successfully. `A` can be a scipy
   sparse matrix or a numpy array.
   '''
+  errors = (np.linalg.LinAlgError,)
+  if HAS_CHOLMOD:
+    errors += (cholmod.CholmodNotPositiveDefiniteError,)
+
   try:
-    PosDefSolver(A).L()
+    # only the success of the factorization matters, so do not
+    # materialize `L`, which requires extracting and permuting the
+    # factor when `A` is sparse
+    PosDefSolver(A)
 
-  except (np.linalg.LinAlgError,
-          cholmod.CholmodNotPositiveDefiniteError):
+  except errors:
     return False
-  
+
   return True
 
 
@@ -481,16 +548,18 @@ class PartitionedSolver(object):
         'There are fewer rows than columns in `B`. This makes the '
         'block matrix singular, and its inverse cannot be computed.')
 
-    # concatenate the A and B matrices 
+    # concatenate the A and B matrices. `bmat` and the preallocated
+    # array assemble the block matrix in one pass, without the
+    # intermediate matrices that nested hstack/vstack calls create
     if sp.issparse(A):
-        Z = sp.csc_matrix((p, p), dtype=float)
-        C = sp.vstack((sp.hstack((A, B)),
-                       sp.hstack((B.T, Z))))
+        C = sp.bmat([[A, B], [B.T, None]], format='csc')
     else:
-        Z = np.zeros((p, p), dtype=float)
-        C = np.vstack((np.hstack((A, B)),
-                       np.hstack((B.T, Z))))
-          
+        C = np.empty((n + p, n + p), dtype=float)
+        C[:n, :n] = A
+        C[:n, n:] = B
+        C[n:, :n] = B.T
+        C[n:, n:] = 0.0
+
     self._solver = Solver(C)
     self.n = n
     
@@ -510,8 +579,10 @@ class PartitionedSolver(object):
     '''
     a = as_array(a, dtype=float)
     b = as_array(b, dtype=float)
-    c = np.concatenate((a, b), axis=0)
-    xy = self._solver.solve(c)
+    c = np.empty((a.shape[0] + b.shape[0],) + a.shape[1:], dtype=float)
+    c[:a.shape[0]] = a
+    c[a.shape[0]:] = b
+    xy = self._solver.solve(c, overwrite_b=True)
     x, y = xy[:self.n], xy[self.n:]
     return x, y
   
@@ -572,8 +643,21 @@ class PartitionedPosDefSolver(object):
         'block matrix singular, and its inverse cannot be computed.')
     
     A_solver = PosDefSolver(A)
-    AiB = A_solver.solve(B) 
-    BtAiB_solver = PosDefSolver(B.T.dot(AiB))
+    AiB = A_solver.solve(B)
+    # `B^T A^-1 B` is symmetric positive definite, so rather than a
+    # general matrix product with `AiB`, compute it as the symmetric
+    # product of `L^-1 B` with itself, which takes half the flops and
+    # is symmetric by construction
+    LiB = A_solver.solve_L(B)
+    if p == 0:
+      # `dsyrk` does not accept a matrix with no columns
+      BtAiB = np.zeros((0, 0), dtype=float)
+
+    else:
+      BtAiB = dsyrk(1.0, LiB, trans=1, lower=1)
+      # `dsyrk` only fills in one triangle
+      BtAiB = BtAiB + np.tril(BtAiB, -1).T
+    BtAiB_solver = PosDefSolver(BtAiB)
     self._AiB = AiB
     self._A_solver = A_solver
     self._BtAiB_solver = BtAiB_solver 
@@ -594,10 +678,23 @@ class PartitionedPosDefSolver(object):
     '''
     a = as_array(a, dtype=float)
     b = as_array(b, dtype=float)
-    Eb  = -self._BtAiB_solver.solve(b)
-    Db  = -self._AiB.dot(Eb)
-    Dta = self._BtAiB_solver.solve(self._AiB.T.dot(a))
-    Ca  = self._A_solver.solve(a) - self._AiB.dot(Dta)
-    x = Ca  + Db    
-    y = Dta + Eb
+    squeeze = (a.ndim == 1)
+    if squeeze:
+      a = a[:, None]
+      b = b[:, None]
+
+    # the factorization of `B^T A^-1 B` is applied to `b` and to
+    # `AiB^T a`, so stack them and sweep the factor over both
+    # right-hand sides at once
+    k = b.shape[1]
+    S = self._BtAiB_solver.solve(np.hstack((b, self._AiB.T.dot(a))),
+                                 overwrite_b=True)
+    negEb, Dta = S[:, :k], S[:, k:]
+    # `x = Ca + Db` and `y = Dta + Eb`, with the two products of `AiB`
+    # fused into one
+    x = self._A_solver.solve(a) + self._AiB.dot(negEb - Dta)
+    y = Dta - negEb
+    if squeeze:
+      x, y = x[:, 0], y[:, 0]
+
     return x, y
@@ -12,6 +12,7 @@ import rbf.fd
 import rbf.mp
 import rbf.basis
 from rbf.poly import memoize
+from rbf.linalg import HAS_CHOLMOD
 import scipy.sparse
 import scipy.sparse.linalg as spla
 from scipy.spatial import cKDTree
@@ -19,69 +20,129 @@ from rbf.interpolate import _in_hull
 import logging
 logger = logging.getLogger(__name__)
 
+if HAS_CHOLMOD:
+  from sksparse import cholmod
+
+try:
+  from numba import njit, prange
+  HAS_NUMBA = True
+
+except ImportError:
+  HAS_NUMBA = False
+
+if HAS_NUMBA:
+  @njit(parallel=True, fastmath=True, cache=True)
+  def _accumulate_sqdiff(mean, sample, out):
+    # accumulates (mean - sample)**2 into *out* with a single fused
+    # pass and no temporary arrays
+    for i in prange(mean.size):
+      d = mean[i] - sample[i]
+      out[i] += d*d
+
+
 class _IterativeVariance:
-  ''' 
-  Computes variances of a random process while the samples are being 
-  generated. This is more memory efficient than first taking all the 
-  samples and then computing the variance.
+  '''
+  Computes variances of a random process while the samples are being
+  generated. This is more memory efficient than first taking all the
+  samples and then computing the variance. The variance is taken
+  around the fixed *mean* given at initialization, rather than around
+  the sample mean, since the posterior mean is known exactly and the
+  samples only exist to estimate the spread about it.
   '''
   def __init__(self,mean):
-    mean = np.asarray(mean)
+    mean = np.asarray(mean,dtype=float)
     self.mean = mean
     self.sum_squared_diff = np.zeros(mean.shape)
     self.count = 0
 
   def add_sample(self,sample):
-    sample = np.asarray(sample)
-    self.sum_squared_diff += (self.mean - sample)**2
+    sample = np.asarray(sample,dtype=float)
+    if HAS_NUMBA:
+      _accumulate_sqdiff(self.mean,sample,self.sum_squared_diff)
+
+    else:
+      self.sum_squared_diff += (self.mean - sample)**2
+
     self.count += 1
 
   def get_variance(self):
     return self.sum_squared_diff / self.count
 
 
+# a point is considered surrounded by data if its nearest data points
+# are within this many multiples of the average data spacing
+_INTERPOLATE_SPACING_FACTOR = 4.0
+
+
 def _get_mask(x,sigma,kind):
-  ''' 
-  Returns an (N,) boolean array identifying where a smoothed estimate 
-  should be made.  
-  
-  * If kind is 'none', then the smoothed solution will not be 
-    estimated at positions where the data uncertainty is inf (i.e. 
+  '''
+  Returns an (N,) boolean array identifying where a smoothed estimate
+  should be made.
+
+  * If kind is 'none', then the smoothed solution will not be
+    estimated at positions where the data uncertainty is inf (i.e.
     the data is missing).
-  
-  * If kind is 'interpolate' then missing data will be filled in as 
-    long as the position of the missing data is within a convex hull 
-    defined by the positions of non-missing data.
-  
+
+  * If kind is 'interpolate' then missing data will be filled in as
+    long as the position of the missing data is surrounded by
+    non-missing data. This is determined with an inexpensive bounding
+    box and nearest neighbor test. Use 'interpolate-exact' for the
+    strict convex hull test, which requires building a Delaunay
+    triangulation of the non-missing data positions.
+
   * If kind is 'extrapolate' then the smoothed solution will be
     estimated for all positions.
-  
+
 
   Parameters
   ----------
   x: (N,D) array
     observation points
-    
+
   sigma: (N,) array
-    uncertainties for each observation point. np.inf indicates that 
+    uncertainties for each observation point. np.inf indicates that
     the observation is missing
-      
+
   kind: str
-    either 'none', 'interpolate', or 'extrapolate'  
-      
+    either 'none', 'interpolate', 'interpolate-exact', or
+    'extrapolate'
+
   '''
-  data_is_missing = np.isinf(sigma) 
+  data_is_missing = np.isinf(sigma)
   if kind == 'none':
     mask = data_is_missing
 
   elif kind == 'interpolate':
+    xd = x[~data_is_missing]
+    if xd.shape[0] == 0:
+      mask = np.ones(sigma.shape,dtype=bool)
+
+    else:
+      # a point is interior if it is within the bounding box of the
+      # non-missing data and its nearest data points are no farther
+      # than a few multiples of the average data spacing
+      T = cKDTree(xd)
+      k = min(2*x.shape[1],xd.shape[0])
+      dist = T.query(x,k)[0]
+      if k == 1:
+        dist = dist[:,None]
+
+      in_bbox = np.all((x >= xd.min(axis=0)) &
+                       (x <= xd.max(axis=0)),axis=1)
+      near_data = (dist[:,-1] <
+                   _INTERPOLATE_SPACING_FACTOR*
+                   _average_shortest_distance(xd))
+      mask = ~(in_bbox & near_data)
+
+  elif kind == 'interpolate-exact':
     mask = ~_in_hull(x,x[~data_is_missing])
 
   elif kind == 'extrapolate':
     mask = np.zeros(sigma.shape,dtype=bool)
 
   else:
-    raise ValueError('*kind* must be "none", "interpolate", or "extrapolate"')
+    raise ValueError('*kind* must be "none", "interpolate", '
+                     '"interpolate-exact", or "extrapolate"')
 
   return mask
 
@@ -120,14 +181,24 @@ def _penalty(cutoff,order,sigma):
   return (2*np.pi*cutoff)**order*_sigma_bar(sigma)
 
 
+# maximum memory, in bytes, for one array of batched perturbations
+# used to estimate uncertainty. Larger problems fall back to solving
+# one perturbation at a time
+_MAX_BATCH_NBYTES = 2**30
+
+
 def _diag(diag):
-  ''' 
-  returns a diagonal csr matrix. Unlike scipy.sparse.diags, this 
+  '''
+  returns a diagonal csc matrix. Unlike scipy.sparse.diags, this
   properly handles zero-length input
   '''
-  K = len(diag)
-  r,c = range(K),range(K)
-  out = scipy.sparse.csr_matrix((diag,(r,c)),(K,K))
+  # write the three csc index arrays directly, which skips the sorting
+  # and deduplication that the triplet constructor does
+  diag = np.asarray(diag,dtype=float)
+  K = diag.shape[0]
+  indices = np.arange(K,dtype=np.int32)
+  indptr = np.arange(K + 1,dtype=np.int32)
+  out = scipy.sparse.csc_matrix((diag,indices,indptr),(K,K))
   return out
      
 
@@ -189,13 +260,17 @@ def filter(x,u,sigma=None,
       
   fill : str, optional
     Indicates how to treat missing data (i.e. data where *sigma* is 
-    np.inf).  This can be either 'none', 'interpolate', or 
-    'extrapolate'. If 'none' then missing data is ignored and the 
-    returned mean and uncertainty at those observation points will be 
-    np.nan and np.inf, respectively. If 'interpolate' then a smoothed 
-    solution will be estimated at missing interior points (i.e. no 
-    extrapolation).  If fill is 'extrapolate' then a smoothed solution 
-    is estimated at every observation point.
+    np.inf).  This can be either 'none', 'interpolate',
+    'interpolate-exact', or 'extrapolate'. If 'none' then missing data
+    is ignored and the returned mean and uncertainty at those
+    observation points will be np.nan and np.inf, respectively. If
+    'interpolate' then a smoothed solution will be estimated at
+    missing interior points (i.e. no extrapolation), where interior
+    points are found with an inexpensive nearest neighbor test. Use
+    'interpolate-exact' to find the interior points with a strict
+    convex hull test, which can be expensive in three or more
+    dimensions.  If fill is 'extrapolate' then a smoothed solution is
+    estimated at every observation point.
 
   diffs : (D,) or (K,D) int array, optional
     If provided then the output will be a derivative of the smoothed 
@@ -264,16 +339,66 @@ def filter(x,u,sigma=None,
     # which are outside of its scope. Note2: this function is memoized 
     # and so it may take up a lot of memory if it is called many times 
     # with different masks
-    mask = np.asarray(mask,dtype=bool)        
+    mask = np.asarray(mask,dtype=bool)
     prior_diffs = p*np.eye(dim,dtype=int)
-    L = rbf.fd.weight_matrix(x[~mask],x[~mask],prior_diffs,**kwargs)
-    D = rbf.fd.weight_matrix(x[~mask],x[~mask],diffs,**kwargs)
-    return L,D  
-                
-  def calculate_posterior(i):
-    # This function calculates the posterior for u[i,:] and 
-    # sigma[i,:]. Note: this function makes use of variables which are 
-    # outside of its scope.
+    # the two operators are built together so that the stencils and
+    # the local linear solves are shared between them
+    L,D = rbf.fd.weight_matrices(x[~mask],x[~mask],
+                                 [prior_diffs,diffs],**kwargs)
+    # cache the Gram matrix of L, which appears in the left-hand side
+    # for every data set with this mask
+    LtL = (L.T.dot(L)).tocsc()
+    return L,D,LtL
+
+  # symbolic factorizations of the left-hand side, keyed by the mask.
+  # The sparsity pattern of the left-hand side only depends on the
+  # mask, so the fill-reducing ordering and symbolic factorization can
+  # be shared across data sets
+  symbolic = {}
+  # the values and factorization of the most recently factored
+  # left-hand side for each mask. Consecutive data sets with the same
+  # uncertainties produce an identical left-hand side, in which case
+  # the numeric factorization is reused outright
+  numeric = {}
+  def factor_lhs(lhs,mask):
+    # factors *lhs*, returning a function which solves *lhs*x = b
+    lhs = lhs.tocsc()
+    cached = numeric.get(mask)
+    if cached is not None and np.array_equal(cached[0],lhs.data):
+      return cached[1]
+
+    solve = _factor_lhs(lhs,mask)
+    numeric[mask] = (lhs.data,solve)
+    return solve
+
+  def _factor_lhs(lhs,mask):
+    if HAS_CHOLMOD:
+      # only redo the numeric factorization when a symbolic
+      # factorization already exists for this mask
+      if mask not in symbolic:
+        symbolic[mask] = cholmod.analyze(lhs)
+
+      factor = symbolic[mask]
+      try:
+        factor.cholesky_inplace(lhs)
+        return factor
+
+      except cholmod.CholmodNotPositiveDefiniteError:
+        # *lhs* is positive definite by construction, but roundoff
+        # can make a Cholesky factorization fail when it is poorly
+        # conditioned. Fall back to an LU factorization
+        logger.debug('Cholesky factorization failed. Falling back to '
+                     'an LU factorization')
+
+    # SuperLU has no symbolic/numeric split, so the whole
+    # factorization is redone for each data set
+    return spla.splu(lhs).solve
+
+  def calculate_posterior(i,post_mean,post_sigma):
+    # This function calculates the posterior for u[i,:] and
+    # sigma[i,:], writing the results into the (N,) arrays *post_mean*
+    # and *post_sigma*. Note: this function makes use of variables
+    # which are outside of its scope.
     logger.debug('evaluating the filtered solution for data set %s ...' % i)
     # identify observation points where we do not want to estimate the 
     # filtered solution
@@ -281,52 +406,143 @@ def filter(x,u,sigma=None,
     # number of unmasked entries
     K = np.sum(~mask)
     # build differentiation matrices
-    L,D = build_L_and_D(tuple(mask))
-    # form weight matrix
-    W = _diag(1.0/sigma[i,~mask])
+    L,D,LtL = build_L_and_D(tuple(mask))
+    # form the data weights, which make up the diagonal of W and
+    # W.T.dot(W) respectively
+    inv_s = 1.0/sigma[i,~mask]
+    inv_s2 = inv_s**2
     # compute penalty parameter
     lamb = _penalty(cutoff,p,sigma[i,~mask])
-    # form left and right hand side of the system to solve
-    lhs = W.T.dot(W) + L.T.dot(L)/lamb**2
-    rhs = W.T.dot(W).dot(u[i,~mask])
-    # generate LU decomposition of left-hand side
-    lu = spla.splu(lhs)
+    # form left and right hand side of the system to solve. The Gram
+    # matrix is cached, so only the scalar scaling is done here
+    lhs = _diag(inv_s2) + LtL/lamb**2
+    rhs = inv_s2*u[i,~mask]
+    # factor the left-hand side
+    solve = factor_lhs(lhs,tuple(mask))
     # compute the smoothed derivative of the posterior mean
-    post_mean = np.empty((N,))
-    post_mean[~mask] = D.dot(lu.solve(rhs))
+    post_mean[~mask] = D.dot(solve(rhs))
     post_mean[mask] = np.nan
     # compute the posterior standard deviation. 
     if exact:
       cov = D.dot(spla.inv(lhs)).dot(D.T)
       var = np.diag(cov.toarray())
-    else:  
-      # compute uncertainty through repeated random perturbations of 
-      # the data and prior vector.
-      ivar = _IterativeVariance(post_mean[~mask])
-      for j in range(samples):
-        w1 = np.random.normal(0.0,1.0,K)
-        w2 = np.random.normal(0.0,1.0,K)
-        # generate sample of the posterior
-        post_sample = lu.solve(rhs + W.T.dot(w1) + L.T.dot(w2)/lamb)
-        # differentiate the sample
-        post_sample = D.dot(post_sample)
-        ivar.add_sample(post_sample)
-    
-      var = ivar.get_variance() 
+    else:
+      # compute uncertainty through repeated random perturbations of
+      # the data and prior vector
+      if 8*K*samples <= _MAX_BATCH_NBYTES:
+        # solve for all the perturbations in one batched call, which
+        # sweeps the factorization over the right-hand sides at once
+        w1 = np.random.normal(0.0,1.0,(K,samples))
+        w2 = np.random.normal(0.0,1.0,(K,samples))
+        # generate samples of the posterior and differentiate them
+        post_samples = D.dot(solve(rhs[:,None] + inv_s[:,None]*w1 +
+                                   L.T.dot(w2)/lamb))
+        var = np.mean((post_samples - post_mean[~mask,None])**2,axis=1)
+
+      else:
+        # the batched right-hand sides would take up too much memory,
+        # so solve for one perturbation at a time
+        ivar = _IterativeVariance(post_mean[~mask])
+        for j in range(samples):
+          w1 = np.random.normal(0.0,1.0,K)
+          w2 = np.random.normal(0.0,1.0,K)
+          # generate sample of the posterior
+          post_sample = solve(rhs + inv_s*w1 + L.T.dot(w2)/lamb)
+          # differentiate the sample
+          post_sample = D.dot(post_sample)
+          ivar.add_sample(post_sample)
+
+        var = ivar.get_variance()
 
-    post_sigma = np.empty((N,))
     post_sigma[~mask] = np.sqrt(var)
     post_sigma[mask] = np.inf
-      
+
     logger.debug('done')
-    return post_mean,post_sigma
-    
-  # Calculate the posterior for each (N,) array in u and sigma. 
-  # This is done in parallel, where *procs* is the number of 
-  # subprocesses spawned.
-  post = rbf.mp.parmap(calculate_posterior,range(Q),workers=procs)
-  post_mean = np.array([k[0] for k in post])
-  post_sigma = np.array([k[1] for k in post])
+
+  def calculate_all_posteriors(post_mean,post_sigma):
+    # Specialization of *calculate_posterior* for when every data set
+    # has the same uncertainties. The left-hand side is then shared by
+    # all the data sets, so the setup is done once and the posterior
+    # means are found with a single batched solve. Note: this function
+    # makes use of variables which are outside of its scope.
+    logger.debug('evaluating the filtered solution for all %s data '
+                 'sets at once ...' % Q)
+    mask = _get_mask(x,sigma[0],fill)
+    K = np.sum(~mask)
+    L,D,LtL = build_L_and_D(tuple(mask))
+    inv_s = 1.0/sigma[0,~mask]
+    inv_s2 = inv_s**2
+    lamb = _penalty(cutoff,p,sigma[0,~mask])
+    lhs = _diag(inv_s2) + LtL/lamb**2
+    # right-hand sides for all the data sets as columns
+    rhs = inv_s2[:,None]*u[:,~mask].T
+    solve = factor_lhs(lhs,tuple(mask))
+    post_mean[:,~mask] = D.dot(solve(rhs)).T
+    post_mean[:,mask] = np.nan
+    if exact:
+      # the posterior covariance does not depend on the data, so it is
+      # the same for every data set
+      cov = D.dot(spla.inv(lhs)).dot(D.T)
+      var = np.diag(cov.toarray())
+      post_sigma[:,~mask] = np.sqrt(var)
+
+    else:
+      # the perturbations are drawn independently for each data set so
+      # that the uncertainty estimates stay uncorrelated, but they all
+      # reuse the factorization from above
+      for i in range(Q):
+        if 8*K*samples <= _MAX_BATCH_NBYTES:
+          w1 = np.random.normal(0.0,1.0,(K,samples))
+          w2 = np.random.normal(0.0,1.0,(K,samples))
+          post_samples = D.dot(solve(rhs[:,i:i+1] + inv_s[:,None]*w1 +
+                                     L.T.dot(w2)/lamb))
+          var = np.mean((post_samples - post_mean[i,~mask,None])**2,
+                        axis=1)
+
+        else:
+          ivar = _IterativeVariance(post_mean[i,~mask])
+          for j in range(samples):
+            w1 = np.random.normal(0.0,1.0,K)
+            w2 = np.random.normal(0.0,1.0,K)
+            post_sample = solve(rhs[:,i] + inv_s*w1 + L.T.dot(w2)/lamb)
+            ivar.add_sample(D.dot(post_sample))
+
+          var = ivar.get_variance()
+
+        post_sigma[i,~mask] = np.sqrt(var)
+
+    post_sigma[:,mask] = np.inf
+
+    logger.debug('done')
+
+  # Calculate the posterior for each (N,) array in u and sigma.
+  if procs == 0:
+    # the parent process does all the work, so each result is written
+    # directly into the preallocated output arrays
+    post_mean = np.empty((Q,N))
+    post_sigma = np.empty((Q,N))
+    if (Q > 1) and np.all(sigma == sigma[0:1]):
+      # every data set has the same uncertainties, which is a common
+      # case where the left-hand side can be shared outright
+      calculate_all_posteriors(post_mean,post_sigma)
+
+    else:
+      for i in range(Q):
+        calculate_posterior(i,post_mean[i],post_sigma[i])
+
+  else:
+    # distribute the tasks among *procs* subprocesses. The
+    # subprocesses cannot write into the parent's memory, so the
+    # results are gathered and then copied into the output arrays
+    def task(i):
+      post_mean_i = np.empty((N,))
+      post_sigma_i = np.empty((N,))
+      calculate_posterior(i,post_mean_i,post_sigma_i)
+      return post_mean_i,post_sigma_i
+
+    post = rbf.mp.parmap(task,range(Q),workers=procs)
+    post_mean = np.array([k[0] for k in post])
+    post_sigma = np.array([k[1] for k in post])
 
   post_mean = post_mean.reshape(input_u_shape)
   post_sigma = post_sigma.reshape(input_u_shape)
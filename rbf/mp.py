@@ -6,7 +6,18 @@ try:
   import mkl
   _HAS_MKL = True
 except ImportError:
-  _HAS_MKL = False    
+  _HAS_MKL = False
+
+try:
+  import numba
+  # numba's default threading layer (TBB, when available) deadlocks at
+  # interpreter exit in any process that forks after a parallel kernel
+  # has run, which is what parmap does. Pin the fork-safe workqueue
+  # layer unless one was explicitly chosen
+  if numba.config.THREADING_LAYER == 'default':
+    numba.config.THREADING_LAYER = 'workqueue'
+except ImportError:
+  pass
 
 class ParmapError(Exception):
   def __init__(self,errors):
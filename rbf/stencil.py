@@ -4,10 +4,13 @@ Difference (RBF-FD) method
 '''
 from __future__ import division
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
 from scipy.spatial import cKDTree
 from rbf.geometry import intersection_count
 from rbf.utils import assert_shape
-import networkx
+import rbf.mp
 
 class StencilError(Exception):
   ''' 
@@ -30,10 +33,12 @@ def stencils_to_edges(stencils):
   '''
   stencils = np.asarray(stencils)
   N, S = stencils.shape
-  node1 = np.arange(N)[:, None].repeat(S, axis=1)
-  node2 = np.array(stencils, copy=True)
-  edges = zip(node1.flatten(), node2.flatten())
-  edges = np.array(edges, dtype=int)
+  # build the edge array directly rather than zipping together python
+  # tuples for each edge, matching the index width of the stencils
+  dtype = np.int32 if stencils.dtype == np.int32 else np.int64
+  edges = np.empty((N*S, 2), dtype=dtype)
+  edges[:, 0] = np.repeat(np.arange(N, dtype=dtype), S)
+  edges[:, 1] = stencils.ravel()
   return edges
 
 
@@ -51,11 +56,17 @@ def is_connected(stencils):
   out : bool
 
   '''
+  stencils = np.asarray(stencils)
   edges = stencils_to_edges(stencils)
-  # edges needs to be a list of tuples
-  edges = [tuple(e) for e in edges] 
-  graph = networkx.Graph(edges)
-  return networkx.is_connected(graph)
+  # count the connected components of the adjacency matrix, which is
+  # done in compiled code and avoids building a networkx graph
+  nodes = max(stencils.shape[0], int(stencils.max()) + 1)
+  adjacency = scipy.sparse.csr_matrix(
+    (np.ones(edges.shape[0], dtype=bool), (edges[:, 0], edges[:, 1])),
+    shape=(nodes, nodes))
+  count = connected_components(adjacency, directed=False,
+                               return_labels=False)
+  return count == 1
 
 
 def connectivity(stencils):
@@ -72,19 +83,43 @@ def connectivity(stencils):
   out : int
 
   '''
+  # networkx is only needed here, so importing it is deferred to keep
+  # the module import fast
+  import networkx
+  stencils = np.asarray(stencils)
   edges = stencils_to_edges(stencils)
-  # edges needs to be a list of tuples
-  edges = [tuple(e) for e in edges] 
-  graph = networkx.Graph(edges)
+  # populate the graph from a sparse adjacency matrix, which skips
+  # turning every edge into a python tuple
+  nodes = max(stencils.shape[0], int(stencils.max()) + 1)
+  adjacency = scipy.sparse.coo_matrix(
+    (np.ones(edges.shape[0], dtype=bool), (edges[:, 0], edges[:, 1])),
+    shape=(nodes, nodes))
+  graph = networkx.from_scipy_sparse_array(adjacency)
   return networkx.node_connectivity(graph)
 
 
-def _closest_argsort(c, x):
-  ''' 
-  Returns the indices of nodes in `x` sorted in order of distance to `c`
+def _closest_argsort(c, x, k=None, xx=None):
+  '''
+  Returns the indices of nodes in `x` sorted in order of distance to
+  `c`. If `k` is given then only the `k` closest nodes are returned.
+  `xx` are optionally the precomputed squared norms of the rows of
+  `x`, which can be reused across calls
   '''
-  dist = np.sum((x - c[None, :])**2, axis=1)
-  idx = np.argsort(dist)
+  if xx is None:
+    xx = np.einsum('ij,ij->i', x, x)
+
+  # squared distances by expansion, dropping the constant `c` term
+  # since it does not change the ordering. The dot product is a single
+  # BLAS call and no (M, D) temporary is formed
+  dist = xx - 2.0*x.dot(c)
+  if (k is None) or (k >= x.shape[0]):
+    idx = np.argsort(dist)
+  else:
+    # partition out the `k` closest nodes and then sort just those,
+    # which avoids sorting all of `x`
+    idx = np.argpartition(dist, k - 1)[:k]
+    idx = idx[np.argsort(dist[idx])]
+
   return idx
 
 
@@ -93,8 +128,9 @@ def _has_intersections(c, x, vert, smp):
   Check if any of the edges (`c`, `x[i]`) intersect the boundary 
   defined by `vert` and `smp`. 
   '''
-  N = len(x)
-  cext = np.repeat(c[None, :], N, axis=0)
+  # present `c` as an (N, D) array through a stride-0 view, which
+  # avoids copying it once for each edge
+  cext = as_strided(c, shape=x.shape, strides=(0, c.strides[0]))
   # number of times each edge intersects the boundary
   count = intersection_count(x, cext, vert, smp)
   # return True if there are intersections
@@ -102,44 +138,99 @@ def _has_intersections(c, x, vert, smp):
   return out
 
 
-def _stencil(c, x, n, vert, smp):
-  ''' 
-  Forms a stencil about `c` made up of `n` nearby nodes in `x`. The 
-  stencil is constrained so that it does not reach across the boundary 
-  defined by `vert` and `smp`.
+def _select_stencil(c, x, n, sorted_idx, vert, smp):
   '''
-  sorted_idx = _closest_argsort(c, x)
-  stencil_idx = []    
+  Picks the first `n` nodes from `sorted_idx` whose edges with `c` do
+  not cross the boundary
+  '''
+  stencil_idx = np.empty(n, dtype=int)
+  count = 0
   for si in sorted_idx:
-    if len(stencil_idx) == n:
+    if count == n:
       break
 
-    stencil_idx += [si]
-    if _has_intersections(c, x[stencil_idx], vert, smp):
-      stencil_idx.pop()
+    # the edges that have already been accepted are known to not cross
+    # the boundary, so only the new edge needs to be tested
+    if not _has_intersections(c, x[si:si + 1], vert, smp):
+      stencil_idx[count] = si
+      count += 1
+
+  return stencil_idx[:count]
+
+
+def _stencil(c, x, n, vert, smp, xx=None):
+  '''
+  Forms a stencil about `c` made up of `n` nearby nodes in `x`. The
+  stencil is constrained so that it does not reach across the boundary
+  defined by `vert` and `smp`. `xx` are optionally the precomputed
+  squared norms of the rows of `x`.
+  '''
+  # the closest few multiples of `n` nodes are usually enough to fill
+  # the stencil, so only that many are sorted
+  k = min(x.shape[0], max(4*n, 64))
+  sorted_idx = _closest_argsort(c, x, k, xx=xx)
+  stencil_idx = _select_stencil(c, x, n, sorted_idx, vert, smp)
+  if (len(stencil_idx) < n) and (k < x.shape[0]):
+    # too many of the closest nodes were rejected, retry with all of
+    # them
+    sorted_idx = _closest_argsort(c, x, xx=xx)
+    stencil_idx = _select_stencil(c, x, n, sorted_idx, vert, smp)
 
   if len(stencil_idx) == n:
     return np.array(stencil_idx, dtype=int)
-  else: 
+  else:
     raise StencilError('cannot not form a stencil with size %s' % n)
 
 
+# the most recently built kd-tree along with the points it was built
+# from. stencil_network is commonly called repeatedly with the same
+# points (e.g. once per differential operator or time step), in which
+# case the tree build can be skipped. The points are compared by
+# identity, so the cache is stale only if the array is mutated in
+# place
+_tree_cache = None
+
+
+def _get_tree(p):
+  '''
+  Returns a kd-tree for the points `p`, reusing the last one if `p`
+  is the same array
+  '''
+  global _tree_cache
+  if (_tree_cache is not None) and (_tree_cache[0] is p):
+    return _tree_cache[1]
+
+  # skip the balancing and compacting passes when building the tree,
+  # which do not pay off for the quasi-uniform point sets used with
+  # RBF-FD
+  T = cKDTree(p, leafsize=32, balanced_tree=False,
+              compact_nodes=False)
+  _tree_cache = (p, T)
+  return T
+
+
 def _stencil_network_no_boundary(x, p, n):
-  ''' 
+  '''
   Returns the `n` nearest points in `p` for each point in `x`
   '''
   if n == 0:
-    out = np.zeros((x.shape[0], 0), dtype=int)
+    out = np.zeros((x.shape[0], 0), dtype=np.int32)
   else:
-    T = cKDTree(p)
-    dummy, out = T.query(x, n)
+    # spread the queries over all cores
+    T = _get_tree(p)
+    dummy, out = T.query(x, n, workers=-1)
     if n == 1:
       out = out[:, None]
 
-  return out 
+  if p.shape[0] < np.iinfo(np.int32).max:
+    # int32 indices halve the memory traffic on the stencil array, and
+    # they are wide enough for any realistic point set
+    out = out.astype(np.int32, copy=False)
+
+  return out
 
 
-def stencil_network(x, p, n, vert=None, smp=None):
+def stencil_network(x, p, n, vert=None, smp=None, procs=0):
   ''' 
   Forms a stencil for each point in `x`. Each stencil is made up of 
   `n` nearby points from `p`. Stencils can be constrained to not 
@@ -162,6 +253,11 @@ def stencil_network(x, p, n, vert=None, smp=None):
   smp : (Q, D) array, optional
     Connectivity of the vertices to form the boundary.
 
+  procs : int, optional
+    Distribute the stencil rebuilds caused by the boundary among this
+    many subprocesses. This defaults to 0 (i.e. the parent process
+    does all the work).
+
   Returns
   -------
   sn : (N, D) array
@@ -196,9 +292,52 @@ def stencil_network(x, p, n, vert=None, smp=None):
   if smp.shape[0] == 0:
     return sn
 
-  # ensure that no stencils intersect the boundary
-  for i in range(Nx):
-    if _has_intersections(x[i], p[sn[i]], vert, smp):
-      sn[i, :] = _stencil(x[i], p, n, vert, smp)
+  # find the stencils that intersect the boundary with a single
+  # batched call, then rebuild just those stencils
+  starts = np.repeat(x, n, axis=0)
+  ends = p[sn.ravel()]
+  count = intersection_count(starts, ends, vert, smp)
+  crosses = (count.reshape(Nx, n) > 0).any(axis=1)
+  bad = np.nonzero(crosses)[0]
+  if bad.shape[0] != 0:
+    # the squared norms of `p` are shared by all the rebuilt stencils
+    pp = np.einsum('ij,ij->i', p, p)
+    T = _get_tree(p)
+    # rebuild each offending stencil from a few times `n` nearby
+    # candidates rather than all of `p`. The candidates for every
+    # rebuilt stencil are fetched with a single parallel query
+    k = min(Np, 3*n)
+    cands = T.query(x[bad], k, workers=-1)[1]
+    if k == 1:
+      cands = cands[:, None]
+
+    def rebuild(args):
+      # rebuilds the stencil for target `i` from the candidates
+      # `cand`, doubling the candidates if they are not enough to get
+      # past the boundary
+      i, cand = args
+      ki = k
+      while True:
+        try:
+          return cand[_stencil(x[i], p[cand], n, vert, smp,
+                               xx=pp[cand])]
+
+        except StencilError:
+          if ki == Np:
+            raise
+
+          ki = min(Np, 2*ki)
+          cand = np.atleast_1d(T.query(x[i], ki)[1])
+
+    if procs == 0:
+      for i, cand in zip(bad, cands):
+        sn[i, :] = rebuild((i, cand))
+
+    else:
+      # the rebuilds are independent of one another, so distribute
+      # them among `procs` subprocesses
+      rows = rbf.mp.parmap(rebuild, list(zip(bad, cands)),
+                           workers=procs)
+      sn[bad] = np.array(rows)
 
   return sn
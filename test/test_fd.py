@@ -177,5 +177,33 @@ class Test(unittest.TestCase):
     w = rbf.fd.weights(x,nodes,(0,1),
                        basis=rbf.basis.phs8)
     self.assertTrue(np.isclose(u.dot(w),diff_true,atol=1e-2))
-    
-                         
+
+  def test_weight_matrices(self):
+    # weight_matrices should return the same matrices as calling
+    # weight_matrix once per operator
+    H = rbf.halton.Halton(2)
+    nodes = H(50)
+
+    lap = [[2,0],[0,2]]
+    dx = [[1,0]]
+    W1a = rbf.fd.weight_matrix(nodes,nodes,lap,n=15,order=2)
+    W1b = rbf.fd.weight_matrix(nodes,nodes,dx,n=15,order=2)
+    W2a,W2b = rbf.fd.weight_matrices(nodes,nodes,[lap,dx],
+                                     n=15,order=2)
+    self.assertTrue(np.allclose(W1a.toarray(),W2a.toarray()))
+    self.assertTrue(np.allclose(W1b.toarray(),W2b.toarray()))
+
+  def test_weight_matrices_small_stencil(self):
+    # the default polynomial order should be lowered to fit a small
+    # stencil, just as weight_matrix does
+    H = rbf.halton.Halton(1)
+    nodes = H(20)
+
+    W1 = rbf.fd.weight_matrix(nodes,nodes,(2,),n=3)
+    W2, = rbf.fd.weight_matrices(nodes,nodes,[(2,)],n=3)
+    self.assertTrue(np.allclose(W1.toarray(),W2.toarray()))
+    # an explicit order that does not fit the stencil should raise a
+    # ValueError rather than a LinAlgError
+    with self.assertRaises(ValueError):
+      rbf.fd.weight_matrices(nodes,nodes,[(2,)],n=3,order=5)
+
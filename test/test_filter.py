@@ -0,0 +1,59 @@
+import numpy as np
+from rbf.misc.filter import _get_mask
+import unittest
+
+class Test(unittest.TestCase):
+  def test_interpolate_interior(self):
+    # a missing point surrounded by data should be filled in by both
+    # the approximate and the exact interior test
+    xd = np.array([[0.0,0.0],
+                   [1.0,0.0],
+                   [0.0,1.0],
+                   [0.5,0.0],
+                   [0.0,0.5],
+                   [0.5,0.5]])
+    x = np.vstack((xd,[[0.3,0.3]]))
+    sigma = np.array(6*[1.0] + [np.inf])
+
+    mask = _get_mask(x,sigma,'interpolate')
+    self.assertTrue(np.all(~mask))
+
+    mask = _get_mask(x,sigma,'interpolate-exact')
+    self.assertTrue(np.all(~mask))
+
+  def test_interpolate_exterior(self):
+    # a missing point far from the data should stay masked with both
+    # kinds
+    xd = np.array([[0.0,0.0],
+                   [1.0,0.0],
+                   [0.0,1.0],
+                   [0.5,0.0],
+                   [0.0,0.5],
+                   [0.5,0.5]])
+    x = np.vstack((xd,[[5.0,5.0]]))
+    sigma = np.array(6*[1.0] + [np.inf])
+
+    mask = _get_mask(x,sigma,'interpolate')
+    self.assertTrue(np.all(mask == 6*[False] + [True]))
+
+    mask = _get_mask(x,sigma,'interpolate-exact')
+    self.assertTrue(np.all(mask == 6*[False] + [True]))
+
+  def test_interpolate_near_hull(self):
+    # a missing point inside the bounding box and near the data but
+    # outside its convex hull is filled in by 'interpolate' and masked
+    # by 'interpolate-exact'
+    xd = np.array([[0.0,0.0],
+                   [1.0,0.0],
+                   [0.0,1.0],
+                   [0.5,0.0],
+                   [0.0,0.5],
+                   [0.5,0.5]])
+    x = np.vstack((xd,[[0.8,0.8]]))
+    sigma = np.array(6*[1.0] + [np.inf])
+
+    mask = _get_mask(x,sigma,'interpolate')
+    self.assertTrue(np.all(mask == 6*[False] + [False]))
+
+    mask = _get_mask(x,sigma,'interpolate-exact')
+    self.assertTrue(np.all(mask == 6*[False] + [True]))